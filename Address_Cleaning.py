@@ -1,42 +1,65 @@
 ## Need to use base, because virtual envs do not have C++ 14.0 or greater. Error is thrown up with pip install usaddress
 ## No problem adding it to base env
 import pandas as pd
+import numpy as np
 import usaddress, pycountry, re # type: ignore
-from tqdm._tqdm_notebook import tqdm_notebook
-tqdm_notebook.pandas()
+import functools, json, sqlite3
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+## tqdm is only used for progress bars. tqdm.auto picks the notebook bar in jupyter and the text bar everywhere else
+try:
+    from tqdm.auto import tqdm
+except ImportError:
+    tqdm = None
 
-def break_up_address(text, include_recipient=False, standardize_names=True, split_zip_code=True, clean_text=True, include_country=False, include_phone=False):
-    ## Tag mapping puts all the pieces of the address into the same fields for usaddress package
-    ## https://usaddress.readthedocs.io/en/latest/
-    tag_mapping={
-        'Recipient': 'Recipient',
-        'AddressNumber': 'Address1',
-        'AddressNumberPrefix': 'Address1',
-        'AddressNumberSuffix': 'Address1',
-        'StreetName': 'Address1',
-        'StreetNamePreDirectional': 'Address1',
-        'StreetNamePreModifier': 'Address1',
-        'StreetNamePreType': 'Address1',
-        'StreetNamePostDirectional': 'Address1',
-        'StreetNamePostModifier': 'Address1',
-        'StreetNamePostType': 'Address1',
-        'CornerOf': 'Address1',
-        'IntersectionSeparator': 'Address1',
-        'LandmarkName': 'Address1',
-        'USPSBoxGroupID': 'Address1',
-        'USPSBoxGroupType': 'Address1',
-        'USPSBoxID': 'Address1',
-        'USPSBoxType': 'Address1',
-        'BuildingName': 'Address2',
-        'OccupancyType': 'Address2',
-        'OccupancyIdentifier': 'Address2',
-        'SubaddressIdentifier': 'Address2',
-        'SubaddressType': 'Address2',
-        'PlaceName': 'City',
-        'StateName': 'State',
-        'ZipCode': 'Zip_Code',
-    }
+## Tag mapping puts all the pieces of the address into the same fields for usaddress package
+## https://usaddress.readthedocs.io/en/latest/
+address_tag_mapping = {
+    'Recipient': 'Recipient',
+    'AddressNumber': 'Address1',
+    'AddressNumberPrefix': 'Address1',
+    'AddressNumberSuffix': 'Address1',
+    'StreetName': 'Address1',
+    'StreetNamePreDirectional': 'Address1',
+    'StreetNamePreModifier': 'Address1',
+    'StreetNamePreType': 'Address1',
+    'StreetNamePostDirectional': 'Address1',
+    'StreetNamePostModifier': 'Address1',
+    'StreetNamePostType': 'Address1',
+    'CornerOf': 'Address1',
+    'IntersectionSeparator': 'Address1',
+    'LandmarkName': 'Address1',
+    'USPSBoxGroupID': 'Address1',
+    'USPSBoxGroupType': 'Address1',
+    'USPSBoxID': 'Address1',
+    'USPSBoxType': 'Address1',
+    'BuildingName': 'Address2',
+    'OccupancyType': 'Address2',
+    'OccupancyIdentifier': 'Address2',
+    'SubaddressIdentifier': 'Address2',
+    'SubaddressType': 'Address2',
+    'PlaceName': 'City',
+    'StateName': 'State',
+    'ZipCode': 'Zip_Code',
+}
 
+## Most addresses parsed in a session that are kept in memory by `tag_address`
+tag_cache_size = 200000
+
+@functools.lru_cache(maxsize=tag_cache_size)
+def tag_address(text):
+    """
+    `usaddress.tag` with `address_tag_mapping`, cached on the cleaned text so a repeated address is only parsed once
+    Returns a `tuple` of (label, value) pairs. If usaddress can not label it, all of the text goes in Address1
+    """
+    ## Repeated label error means the parser did not work or the address itself is most likely messed up (this one usually if error)
+    ## Get the dict from the output -> hense the [0]
+    try:
+        return tuple(usaddress.tag(text, tag_mapping=address_tag_mapping)[0].items())
+    except usaddress.RepeatedLabelError as e:
+        return (("Address1", text),)
+
+def break_up_address(text, include_recipient=False, standardize_names=True, split_zip_code=True, clean_text=True, include_country=False, include_phone=False):
     ## Load a dict to return with groups from mapping above
     result_dict = {
         'Address1': '',
@@ -73,15 +96,10 @@ def break_up_address(text, include_recipient=False, standardize_names=True, spli
     if include_phone:
         phone, text = parse_phone(text)
 
-    ## Repeated label error means the parser did not work or the address itself is most likely messed up (this one usually if error)
-    ## Get the dict from the output -> hense the [0]
     text= text.strip()
-    try:
-        tagged_addr = usaddress.tag(text, tag_mapping=tag_mapping)[0]
-    except usaddress.RepeatedLabelError as e:
-        tagged_addr = {"Address1": text}
+    tagged_addr = tag_address(text)
 
-    result_dict.update((k, v.upper()) for k, v in tagged_addr.items() if k in result_dict)
+    result_dict.update((k, v.upper()) for k, v in tagged_addr if k in result_dict)
 
     ## Do Extra Stuff
     ## Standardize Names of Streets ex: st -> street
@@ -100,7 +118,7 @@ def break_up_address(text, include_recipient=False, standardize_names=True, spli
     
     return result_dict
 
-def make_new_address_columns(data, address_column, new_columns_prefix="", append_to_original_data=True, include_recipient=False, standardize_names=True, clean_text=True, split_zip_code=True, include_country=False, include_phone=False):
+def make_new_address_columns(data, address_column, new_columns_prefix="", append_to_original_data=True, include_recipient=False, standardize_names=True, clean_text=True, split_zip_code=True, include_country=False, include_phone=False, cache_path=None, n_jobs=1, chunk_size=10000, show_progress=True):
     """
     Main function in the package. Using an address column (one string with all address info available per record), break up the address into its own columns
         - data:                       data that has the address information
@@ -111,29 +129,29 @@ def make_new_address_columns(data, address_column, new_columns_prefix="", append
         - standardize_names:          Default is True. Replaces street abbr in address1 and address2 with full name of street (Example: ave -> avenue)
         - split_zip_code:             Default is True. Splits zip code into zip and zip4. Does this by looking for a '-' and splitting on that
         - include_country:            Default is False. Will look for a country name in address and include it in the output if found. Do not need if all US addresses are expected
+        - cache_path:                 Default is None. Path to a sqlite file that keeps parsed addresses between runs (see `parse_addresses`)
+        - n_jobs:                     Default is 1. Number of processes that parse the addresses, in chunks of chunk_size addresses
+        - show_progress:              Default is True. Shows a progress bar per chunk if tqdm is installed
     """
     data = data.reset_index(drop=True).copy()
     if type(address_column) == list:
         data['Combined Address'] = data[address_column].apply(lambda row: ' '.join(row.values.astype(str)), axis=1)
-        address_df =  pd.DataFrame(data['Combined Address'].progress_apply(lambda x: break_up_address(
-            x, 
-            include_recipient=include_recipient, 
-            standardize_names=standardize_names,
-            clean_text=clean_text,
-            split_zip_code=split_zip_code, 
-            include_country=include_country,
-            include_phone=include_phone
-        )).to_list())
+        address_values = data['Combined Address']
     else:
-        address_df =  pd.DataFrame(data[address_column].progress_apply(lambda x: break_up_address(
-                x, 
-                include_recipient=include_recipient, 
-                standardize_names=standardize_names, 
-                clean_text=clean_text,
-                split_zip_code=split_zip_code, 
-                include_country=include_country,
-                include_phone=include_phone
-            )).to_list())
+        address_values = data[address_column]
+    address_df = parse_addresses(
+        address_values,
+        include_recipient=include_recipient,
+        standardize_names=standardize_names,
+        clean_text=clean_text,
+        split_zip_code=split_zip_code,
+        include_country=include_country,
+        include_phone=include_phone,
+        cache_path=cache_path,
+        n_jobs=n_jobs,
+        chunk_size=chunk_size,
+        show_progress=show_progress
+    )
     ## Rename columns
     rename_columns_dict = {v: new_columns_prefix+v for v in address_df.columns.to_list()}
     address_df = address_df.rename(rename_columns_dict, axis=1)
@@ -147,6 +165,89 @@ def make_new_address_columns(data, address_column, new_columns_prefix="", append
     return address_df
 
 
+def parse_addresses(values, include_recipient=False, standardize_names=True, split_zip_code=True, clean_text=True, include_country=False, include_phone=False, cache_path=None, n_jobs=1, chunk_size=10000, show_progress=True):
+    """
+    Runs `break_up_address` once per unique address and spreads the results back to every row (files are full of repeats)
+        - values:                     `Series` of address strings
+        - cache_path:                 Default is None. Path to a sqlite file of parsed addresses. Addresses already in it are
+                                      not parsed again and new ones are added, so results are reused between runs. Saved by the
+                                      address text and the options, so changing an option parses them again
+        - n_jobs:                     Default is 1. Above 1 the chunks are parsed in that many processes. Results keep their order
+        - chunk_size:                 Default is 10000. Addresses parsed at a time (and the steps of the progress bar)
+        - show_progress:              Default is True. Shows a progress bar per chunk if tqdm is installed
+        - Other options are the same as `break_up_address`
+    Returns a `DataFrame` with one row per value
+    """
+    options = dict(include_recipient=include_recipient, standardize_names=standardize_names, split_zip_code=split_zip_code, clean_text=clean_text, include_country=include_country, include_phone=include_phone)
+    codes, uniques = factorize_values(values)
+    unique_results = [None] * len(uniques)
+    is_cached = [False] * len(uniques)
+
+    if cache_path is not None:
+        connection = sqlite3.connect(cache_path)
+        connection.execute('CREATE TABLE IF NOT EXISTS parsed_addresses (address TEXT, options TEXT, result TEXT, PRIMARY KEY (address, options))')
+        options_key = json.dumps(options, sort_keys=True)
+        text_positions = {text: i for i, text in enumerate(uniques) if isinstance(text, str)}
+        text_list = list(text_positions)
+        ## Look up in batches, sqlite limits how many values can be in one query
+        for start in range(0, len(text_list), 500):
+            batch = text_list[start:start + 500]
+            query = 'SELECT address, result FROM parsed_addresses WHERE options = ? AND address IN ({})'.format(','.join('?' * len(batch)))
+            for text, result in connection.execute(query, [options_key] + batch):
+                unique_results[text_positions[text]] = json.loads(result)
+                is_cached[text_positions[text]] = True
+
+    new_positions = [i for i in range(len(uniques)) if not is_cached[i]]
+    new_texts = list(uniques[new_positions])
+    chunks = [new_texts[i:i + chunk_size] for i in range(0, len(new_texts), chunk_size)]
+    progress = tqdm(total=len(chunks), unit='chunk', disable=not show_progress) if tqdm is not None else None
+    new_results = []
+    if n_jobs > 1 and len(chunks) > 1:
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            for chunk_results in executor.map(break_up_address_chunk, chunks, repeat(options)):
+                new_results.extend(chunk_results)
+                if progress is not None:
+                    progress.update(1)
+    else:
+        for chunk in chunks:
+            new_results.extend(break_up_address_chunk(chunk, options))
+            if progress is not None:
+                progress.update(1)
+    if progress is not None:
+        progress.close()
+    for i, result in zip(new_positions, new_results):
+        unique_results[i] = result
+
+    if cache_path is not None:
+        connection.executemany(
+            'INSERT OR REPLACE INTO parsed_addresses VALUES (?, ?, ?)',
+            [(uniques[i], options_key, json.dumps(result)) for i, result in zip(new_positions, new_results) if isinstance(uniques[i], str)]
+        )
+        connection.commit()
+        connection.close()
+
+    return pd.DataFrame(unique_results).take(codes).reset_index(drop=True) if len(codes) > 0 else pd.DataFrame()
+
+def factorize_values(values):
+    """
+    Codes and uniques of a column, so a function only has to run once per unique value
+    Missing values get one unique per type, since str(None) and str(NaN) are not the same. Each unique is the first row
+    that has it, so a None stays None
+    Returns the codes (one per value) and an `array` of the uniques
+    """
+    values = pd.Series(values).to_numpy(dtype=object)
+    codes = pd.factorize(values)[0]
+    is_missing = codes == -1
+    if is_missing.any():
+        codes[is_missing] = codes.max() + 1 + pd.factorize(np.array([type(x).__name__ for x in values[is_missing]], dtype=object))[0]
+    return codes, values[np.unique(codes, return_index=True)[1]]
+
+def break_up_address_chunk(texts, options):
+    """
+    `break_up_address` for a `list` of addresses. Runs in the worker processes of `parse_addresses`
+    """
+    return [break_up_address(text, **options) for text in texts]
+
 def create_road_replacement_dict():
     """
     ## On 10-17-22 switched from going from abbr to full name, and now go all full names or abbrevations to official UPS abbreviation
@@ -158,19 +259,72 @@ def create_road_replacement_dict():
     'HIWAY':'HWY','HIWY':'HWY','HWAY':'HWY','HILL':'HL','HILLS':'HLS','HLLW':'HOLW','HOLLOW':'HOLW','HOLLOWS':'HOLW','HOLWS':'HOLW','ISLAND':'IS','ISLND':'IS','ISLANDS':'ISS','ISLNDS':'ISS','ISLES':'ISLE','JCTION':'JCT','JCTN':'JCT','JUNCTION':'JCT','JUNCTN':'JCT','JUNCTON':'JCT','JCTNS':'JCTS','JUNCTIONS':'JCTS','KEY':'KY','KEYS':'KYS','KNOL':'KNL','KNOLL':'KNL','KNOLLS':'KNLS','LAKE':'LK','LAKES':'LKS','LANDING':'LNDG','LNDNG':'LNDG','LANE':'LN','LIGHT':'LGT','LIGHTS':'LGTS','LOAF':'LF','LOCK':'LCK','LOCKS':'LCKS','LDGE':'LDG','LODG':'LDG','LODGE':'LDG','LOOPS':'LOOP','MANOR':'MNR','MANORS':'MNRS','MEADOW':'MDW','MDW':'MDWS','MEADOWS':'MDWS','MEDOWS':'MDWS','MILL':'ML','MILLS':'MLS','MISSN':'MSN','MSSN':'MSN','MOTORWAY':'MTWY','MNT':'MT','MOUNT':'MT','MNTAIN':'MTN','MNTN':'MTN','MOUNTAIN':'MTN','MOUNTIN':'MTN','MTIN':'MTN','MNTNS':'MTNS','MOUNTAINS':'MTNS','NECK':'NCK','ORCHARD':'ORCH','ORCHRD':'ORCH','OVL':'OVAL','OVERPASS':'OPAS','PRK':'PARK','PARKS':'PARK','PARKWAY':'PKWY','PARKWY':'PKWY','PKWAY':'PKWY','PKY':'PKWY','PARKWAYS':'PKWY','PKWYS':'PKWY','PASSAGE':'PSGE','PATHS':'PATH','PIKES':'PIKE','PINE':'PNE','PINES':'PNES','PLAIN':'PLN','PLAINS':'PLNS','PLAZA':'PLZ','PLZA':'PLZ','POINT':'PT','POINTS':'PTS','PORT':'PRT','PORTS':'PRTS','PRAIRIE':'PR','PRR':'PR','RAD':'RADL','RADIAL':'RADL','RADIEL':'RADL','RANCH':'RNCH','RANCHES':'RNCH','RNCHS':'RNCH','RAPID':'RPD','RAPIDS':'RPDS','REST':'RST','RDGE':'RDG','RIDGE':'RDG','RIDGES':'RDGS','RIVER':'RIV','RVR':'RIV','RIVR':'RIV','ROAD':'RD','ROADS':'RDS','ROUTE':'RTE','SHOAL':'SHL','SHOALS':'SHLS','SHOAR':'SHR','SHORE':'SHR','SHOARS':'SHRS','SHORES':'SHRS','SKYWAY':'SKWY','SPNG':'SPG','SPRING':'SPG','SPRNG':'SPG','SPNGS':'SPGS','SPRINGS':'SPGS','SPRNGS':'SPGS','SPURS':'SPUR','SQR':'SQ','SQRE':'SQ','SQU':'SQ','SQUARE':'SQ','SQRS':'SQS','SQUARES':'SQS','STATION':'STA','STATN':'STA','STN':'STA','STRAV':'STRA','STRAVEN':'STRA','STRAVENUE':'STRA','STRAVN':'STRA','STRVN':'STRA','STRVNUE':'STRA','STREAM':'STRM','STREME':'STRM','STREET':'ST','STRT':'ST','STR':'ST','STREETS':'STS','SUMIT':'SMT','SUMITT':'SMT','SUMMIT':'SMT','TERR':'TER','TERRACE':'TER','THROUGHWAY':'TRWY','TRACE':'TRCE',
     'TRACES':'TRCE','TRACK':'TRAK','TRACKS':'TRAK','TRK':'TRAK','TRKS':'TRAK','TRAFFICWAY':'TRFY','TRAIL':'TRL','TRAILS':'TRL','TRLS':'TRL','TRAILER':'TRLR','TRLRS':'TRLR','TUNEL':'TUNL','TUNLS':'TUNL','TUNNEL':'TUNL','TUNNELS':'TUNL','TUNNL':'TUNL','TRNPK':'TPKE','TURNPIKE':'TPKE','TURNPK':'TPKE','UNDERPASS':'UPAS','UNION':'UN','UNIONS':'UNS','VALLEY':'VLY','VALLY':'VLY','VLLY':'VLY','VALLEYS':'VLYS','VDCT':'VIA','VIADCT':'VIA','VIADUCT':'VIA','VIEW':'VW','VIEWS':'VWS','VILL':'VLG','VILLAG':'VLG','VILLAGE':'VLG','VILLG':'VLG','VILLIAGE':'VLG','VILLAGES':'VLGS','VILLE':'VL','VIST':'VIS','VISTA':'VIS','VST':'VIS','VSTA':'VIS','WALKS':'WALK','WY':'WAY','WELL':'WL','WELLS':'WLS',}
 
-def replace_names(text, roads_name_dict=None):
+def resolve_road_replacements(roads_name_dict):
+    """
+    Turns a replacement dict into one that gives the final value of each word in one lookup
+    `replace_names` used to run one regex per key in dict order, so a value that is also a later key got replaced again
+    (MEADOW -> MDW -> MDWS). A key's value can only be replaced again by a key after it, so going through the keys from
+    last to first, each key ends at the final value of its value (if that is a later key) or at its value
+    Returns `None` if a key is not one whole word (like 'P.O.') or a value is not one whole word or blank (like
+    'SAINT JAMES'). Those can only be done with the regex per key
+    """
+    if not all(isinstance(k, str) and isinstance(v, str) and word_pattern.fullmatch(k) and (v == '' or word_pattern.fullmatch(v)) for k, v in roads_name_dict.items()):
+        return None
+    places = {k: place for place, k in enumerate(roads_name_dict)}
+    items = list(roads_name_dict.items())
+    resolved = {}
+    for place in range(len(items) - 1, -1, -1):
+        k, v = items[place]
+        resolved[k] = resolved[v] if places.get(v, -1) > place else v
+    return dict((k, resolved[k]) for k in roads_name_dict)
+
+## The last custom dict passed to `replace_names`, so calling it row by row with the same dict only resolves it once
+last_road_replacements = {'items': None, 'resolved': None}
+
+def cached_road_replacements(roads_name_dict):
+    """
+    `resolve_road_replacements` of a custom dict, reused while the same items keep being passed (checked by value, so a
+    dict that was changed since is resolved again)
+    """
+    items = tuple(roads_name_dict.items())
+    if last_road_replacements['items'] != items:
+        last_road_replacements['resolved'] = resolve_road_replacements(roads_name_dict)
+        last_road_replacements['items'] = items
+    return last_road_replacements['resolved']
+
+## Built once when the module loads, instead of every time `replace_names` is called
+word_pattern = re.compile(r"\w+")
+road_replacements = resolve_road_replacements(create_road_replacement_dict())
+
+def replace_names(text, roads_name_dict=None, road_replacements_dict=None):
     ## Used to replace abbr with full name to standardize addresses
     s = str(text).upper()
     ## This list was saved in a file C:\Users\Callan.Mix\OneDrive - Kroll\Documents\DataTeamScripts\Toolkit\Addresses\Data\Common_Street_Abbrevations_Official_Abbrevations.csv
     ## Originally from https://pe.usps.com/text/pub28/28apc_002.htm 
     ## We use a manual list to save time from loading from disk (changed to seperate function 7-22-22) `create_road_replacement_dict()`
-    if roads_name_dict == None:
-        roads_name_dict = create_road_replacement_dict()
-    for k,v in roads_name_dict.items():
-        s = re.sub(r"\b" + k + r"\b", v, s)
+    ## Each word is looked up once in the resolved dict (see `resolve_road_replacements`). Pass road_replacements_dict
+    ## to skip resolving a custom roads_name_dict on every call
+    if road_replacements_dict is None:
+        road_replacements_dict = road_replacements if roads_name_dict is None else cached_road_replacements(roads_name_dict)
+    if road_replacements_dict is not None:
+        s = word_pattern.sub(lambda match: road_replacements_dict.get(match.group(), match.group()), s)
+    else:
+        for k,v in roads_name_dict.items():
+            s = re.sub(r"\b" + k + r"\b", v, s)
     s = re.sub(r"\.", "", s)
     return s
 
+def replace_names_column(values, roads_name_dict=None):
+    """
+    `replace_names` for a whole column. The dict is resolved once and each unique value is only standardized once
+    Returns a `Series` with the same index
+    """
+    values = pd.Series(values)
+    road_replacements_dict = road_replacements if roads_name_dict is None else cached_road_replacements(roads_name_dict)
+    codes, uniques = factorize_values(values)
+    standardized = np.array([replace_names(x, roads_name_dict, road_replacements_dict) for x in uniques], dtype=object)
+    return pd.Series(standardized[codes], index=values.index, dtype=object)
+
 ### Here is some custom logic to add to the countries list
 class Country:
   def __init__(self, alpha_2='', alpha_3='', flag='', name='', numeric=''):
@@ -187,24 +341,72 @@ for c in pycountry.countries:
 pycountry.countries.objects.append(Country(alpha_2='CZ', alpha_3='CZE', flag='', name='CZECH REPUBLIC', numeric='420'))
 pycountry.countries.objects.append(Country(alpha_2='TW', alpha_3='TWN', flag='', name='TAIWAN', numeric='158'))
 
+@functools.lru_cache(maxsize=None)
+def country_lookup():
+    """
+    Built the first time `find_countries` is called (after the custom countries above are added), then reused
+    Returns a `dict` with:
+        - names / alpha_3: Upper cased name or alpha 3 code -> place of the first country with it in `pycountry.countries`
+        - patterns: (place, compiled regex) for names that have regex characters, like 'COCOS (KEELING) ISLANDS'. The
+          old search used the name as a regex, so these keep doing that
+        - max_words: Most words in one name, the longest span of words that needs to be looked up
+    """
+    names, alpha_3, patterns = {}, {}, []
+    for place, country in enumerate(pycountry.countries):
+        name = country.name.upper()
+        ## A name that starts and ends with a letter or number only matches \b...\b where a word starts and a word ends
+        if re.fullmatch(r"\w(.*\w)?", name) and not re.search(r"[.^$*+?{}\[\]\\|()]", name):
+            names.setdefault(name, place)
+        else:
+            patterns.append((place, re.compile(r'\b' + name + r'\b')))
+        alpha_3.setdefault(country.alpha_3.upper(), place)
+    return {
+        'countries': [country.name.upper() for country in pycountry.countries],
+        'names': names,
+        'alpha_3': alpha_3,
+        'patterns': patterns,
+        'max_words': max(len(re.findall(r"\w+", name)) for name in names),
+    }
+
 def find_countries(text):
     """
     Here we use the pycountry package to locate contries in a string. It is just a hard lookup where we go
     through a list of countries looking for its full name or abbr. We only look after the last digits in a 
     string (What we hope is the zip code)
+    Every span of whole words is looked up in `country_lookup` once instead of searching for every country. The first
+    country in pycountry order wins, and its name wins over its alpha 3 code, the same as searching them in order
     """
     if (text == '') or text is None:
         return ("","")
     ## Only look after zip code
     text = re.findall("\D+", text)[-1].upper()
-    result_list = []
-    for country in pycountry.countries:
-        # It needs to be on its own (hence word break on both sides)
-        if re.search(r'\b' + country.name.upper() + r'\b', text):
-            result_list.append((country.name.upper(), country.name.upper()))
-        elif re.search(r'\b' + country.alpha_3.upper() + r'\b', text):
-            result_list.append((country.name.upper(), country.alpha_3.upper()))
-    return result_list[0] if len(result_list) >= 1 else ("","")
+    lookup = country_lookup()
+    words = [(match.start(), match.end()) for match in word_pattern.finditer(text)]
+    found = []
+    for i, (word_start, word_end) in enumerate(words):
+        if text[word_start:word_end] in lookup['alpha_3']:
+            found.append((lookup['alpha_3'][text[word_start:word_end]], 1, text[word_start:word_end]))
+        for _, span_end in words[i:i + lookup['max_words']]:
+            if text[word_start:span_end] in lookup['names']:
+                found.append((lookup['names'][text[word_start:span_end]], 0, text[word_start:span_end]))
+    for place, pattern in lookup['patterns']:
+        if pattern.search(text):
+            found.append((place, 0, lookup['countries'][place]))
+    if len(found) == 0:
+        return ("","")
+    place, _, found_text = min(found)
+    return (lookup['countries'][place], found_text)
+
+def find_countries_column(values):
+    """
+    `find_countries` for a whole column. Each unique value is only looked up once
+    Returns a `Series` of (country, found text) tuples with the same index
+    """
+    values = pd.Series(values)
+    codes, uniques = factorize_values(values)
+    found = np.empty(len(uniques), dtype=object)
+    found[:] = [find_countries(x) for x in uniques]
+    return pd.Series(found[codes], index=values.index, dtype=object)
 
 ####### Helpers For After Main Parse ###########
 def parse_phone(text):
@@ -328,13 +530,9 @@ def clean_standardize_address_columns(data, address_col_list):
     For the moment this is designed for just addr1 and addr2 columns. You pass in one or both and it will clean it up
     """
     data = data.copy()
-    road_names_dict = create_road_replacement_dict()
-    def standardize_stuff(addr, road_names_dict=road_names_dict):
-        temp = str(addr)
-        temp = clean_spaces(temp)
-        temp = clean_name(temp)
-        temp = replace_names(temp, road_names_dict)
-        return temp
     for col in address_col_list:
-        data[col] = [standardize_stuff(addr) for addr in data[col].to_list()]
+        ## Clean each unique value once, then standardize the street names of the whole column
+        codes, uniques = factorize_values(data[col])
+        cleaned = np.array([clean_name(clean_spaces(str(addr))) for addr in uniques], dtype=object)
+        data[col] = replace_names_column(pd.Series(cleaned[codes], index=data.index, dtype=object))
     return data
\ No newline at end of file
@@ -1,6 +1,17 @@
 ## Import Packages
 import pandas as pd
+import numpy as np
+import os
 import re
+import sys
+import time
+import logging
+import warnings
+try:
+    import resource
+except ImportError:
+    #### resource is not on Windows. Peak memory is left as None there
+    resource = None
 
 #########################################
 ### Main Functions
@@ -18,7 +29,12 @@ def dedupe_dataframe(
     add_rank_column=False,
     rank_column_name='', 
     columns_to_simplify=[],
-    reset_blank_dedupe_combinations=True
+    reset_blank_dedupe_combinations=True,
+    stage_callback=None,
+    normalize_all_columns=False,
+    max_expanded_columns=None,
+    expand_max_memory=None,
+    expand_format='wide'
 ):
     """
     ### Function: dedupe_dataframe
@@ -35,6 +51,11 @@ def dedupe_dataframe(
     - keep_dedupe_id_col: Include the Column Dedupe_ID in the output df
     - columns_to_expand: A `list` of columns that will be expanded out (ex Phone -> Phone_1, Phone_2, Phone_3, ect..)
         - These are taken as a set. So if multiple rows have the same exact info in cols provided, only one will be expanded
+        - max_expanded_columns: Most columns made per expanded column (ex 3 keeps Phone_1 to Phone_3). Default keeps all of them
+        - expand_max_memory: Rough budget in bytes for the expanded columns. Fewer columns are kept to fit in it
+        - Without either limit, an expansion over 100,000,000 cells is cut down to fit and a warning is given
+        - expand_format: 'wide' (default) for Phone_1, Phone_2, ... or 'list' to replace each column with a `list` of its
+            values in the group (no extra columns, so no limit is needed)
     - sort_column: Used in the rank column and the dedupe output. The column will be sorted on ascending (defualt) and the first will be taken
     - sort_ascending: If a sort column is provided, you can choose if you want to sort ascending or not (ascending is the defualt)
     - add_rank_column: The first item in group with be listed as 1, the next as 2, and so forth
@@ -46,114 +67,101 @@ def dedupe_dataframe(
         - Dedupe_Id = -1
         - Rank = 1
         - Dedupe_Count = 1
+    - stage_callback: Optional function that is called with a `dict` after each stage (see `report_stage`). Default is silent
+        - Stages: normalize, dedupe_id, aggregations, expand, sort, rank, output
+        - Use `make_logging_callback` to send them to a logger
+    - normalize_all_columns: Spaces are collapsed and text upper cased (see `normalize_text`) only in the columns used here
+        (dedupe, simplify, expand, aggregation and sort columns). Set True to clean every column like older versions
     """
     ### Work on a copy of the data
     data = data.copy()
-    #### Standardize the data a bit before using it
-    print('\rCleaning all data before any changes', end=" "*50)
-    data = data.applymap(lambda x: " ".join(x.split()).upper().strip() if isinstance(x, str) else x)
+    rows_in = len(data)
+    #### Standardize the data a bit before using it. Only the columns that are used unless asked for all of them
+    stage_start = start_stage(stage_callback)
+    if normalize_all_columns:
+        columns_to_normalize = list(data.columns)
+    else:
+        columns_to_normalize = deduping_columns + columns_to_simplify + columns_to_expand + [agg['Agg_Column_Name'] for agg in additional_aggs] + [data.columns[0] if sort_column == '' else sort_column]
+    data = normalize_columns(data, columns_to_normalize)
+    report_stage(stage_callback, 'dedupe_dataframe', 'normalize', stage_start, rows_in, len(data))
 
     #### Combine and simplify columns. Remove old columns from dedupe list and add new column
     #### Run the dedupe id count and drop new column
     #### Else just run the dedupe count function
-    print('\rAdding Dedupe Count and Dedupe Id', end=" "*50)
+    stage_start = start_stage(stage_callback)
     if len(columns_to_simplify) > 0:
         ## All columns to simplify must be contained in the deduping_columns list
         assert sum([1 for col in columns_to_simplify if col in deduping_columns]) == len(columns_to_simplify), "The columns to simplify must be in the columns to dedupe"
         data['Simplified_Cols'] = data[columns_to_simplify].apply(lambda x: " ".join([simplify_text(x[col]) for col in columns_to_simplify]), axis=1)
         deduping_columns = [col for col in deduping_columns if col not in columns_to_simplify]
         deduping_columns = deduping_columns + ['Simplified_Cols']
-        data = add_dedupe_count_column(data, deduping_columns, reset_blank_dedupe_combinations=reset_blank_dedupe_combinations)
+        data = add_dedupe_id_column(data, deduping_columns, reset_blank_dedupe_combinations=reset_blank_dedupe_combinations)
         data = data.drop('Simplified_Cols', axis=1)
     else:
-        data = add_dedupe_count_column(data, deduping_columns, reset_blank_dedupe_combinations=reset_blank_dedupe_combinations)
+        data = add_dedupe_id_column(data, deduping_columns, reset_blank_dedupe_combinations=reset_blank_dedupe_combinations)
+    #### Number the groups once. The counts, aggregations, rank and output below all reuse these codes
+    group_codes, group_ids = number_groups(data['Dedupe_ID'].to_numpy())
+    group_counts = np.bincount(group_codes, minlength=len(group_ids))
+    data['Dedupe_Count'] = group_counts[group_codes]
+    if reset_blank_dedupe_combinations:
+        data['Dedupe_Count'] = np.where(data['Dedupe_ID'].to_numpy() == -1, 1, data['Dedupe_Count'].to_numpy())
+    report_stage(stage_callback, 'dedupe_dataframe', 'dedupe_id', stage_start, rows_in, len(data))
 
     #### If no sort column provided, just use the first column as the sort (basically random/order df provided)
     if sort_column=='':
         sort_column = data.columns[0]
 
     if len(additional_aggs) > 0:
-        print('\rDoing Addtional Aggregations', end=" "*50)
-        for agg in additional_aggs:
+        stage_start = start_stage(stage_callback)
+        #### One groupby on the group codes is shared by every aggregation. It is only rebuilt when a column it reads changes
+        grouped = None
+        for agg_number, agg in enumerate(additional_aggs):
             #### We need to be able to change the dtype to something that can be summed if it is a text
             if agg['Change_Dtype']==float or agg['Change_Dtype']==int:
                 data[agg['Agg_Column_Name']] = pd.to_numeric(data[agg['Agg_Column_Name']], errors='coerce').fillna('', downcast='infer')
+                grouped = None
             #### Error handling
             elif agg['Change_Dtype'] is not None:
                 data[agg['Agg_Column_Name']] = data[agg['Agg_Column_Name']].astype(agg['Change_Dtype'], errors='ignore')
+                grouped = None
             #### Perform the aggregation
-            data[agg['New_Column_Name']] = data.groupby(['Dedupe_ID'])[agg['Agg_Column_Name']].transform(agg['Agg_Type'])
+            if grouped is None:
+                grouped = data.groupby(group_codes, sort=False)
+            data[agg['New_Column_Name']] = grouped[agg['Agg_Column_Name']].transform(agg['Agg_Type'])
+            if agg['New_Column_Name'] in [later['Agg_Column_Name'] for later in additional_aggs[agg_number + 1:]]:
+                grouped = None
+        report_stage(stage_callback, 'dedupe_dataframe', 'aggregations', stage_start, rows_in, len(data))
 
     ### This section applies if there are choosen columns to expand
     if len(columns_to_expand) != 0:
-        print('\rExapanding Chosen Columns', end=" "*50)
-        throw_error_clause = False
-        #### Group by columns desired so if multiple rows have the same exact info in cols provided, only one will be expanded
-        temp = data[['Dedupe_ID'] + columns_to_expand].groupby(['Dedupe_ID'] + columns_to_expand).first().reset_index()
-        #### Added on 10-13-22 if there is only one column being expanded, then lets not have any blanks
-        if len(columns_to_expand) == 1:
-            temp = temp[(temp[columns_to_expand[0]]!='') & (temp[columns_to_expand[0]].notnull())]
-        temp['Key_ID'] = temp.groupby('Dedupe_ID').cumcount() + 1
-        
-        #### If there are too many columns and rows in the pivot, it will time out. Limit to 100,000,000 entries (timeout on example at 1.6 Billion)
-        max_entries = len(temp['Dedupe_ID'].unique()) * temp['Key_ID'].max() * len(columns_to_expand)
-        min_entries = len(temp['Dedupe_ID'].unique()) * len(columns_to_expand)
-        limit_on_entries = 100000000
-        ## Check if it hits the limit. If it does calculate max columns under limit. Prompt user to choose. They may use max,
-        ## use their own number, or skip the expansion process
-        if max_entries > limit_on_entries: 
-            max_columns_possible_under_limit = int(limit_on_entries / min_entries)
-            input_text = """The current expansion will result in {:,} cells. To avoid a timeout we need to limit that to under {:,}.
-            \nYou will only be able to have {} column(s) per expansion to stay under the limit. If this is fine, please hit enter,
-            otherwise enter a number to use. \nType 'X', 'EXIT', 'STOP' to skip expansion processes of deduping.
-            """.format(max_entries, limit_on_entries, max_columns_possible_under_limit)
-            while True:
-                try:
-                    user_choice = input(input_text)
-                    if user_choice == '':
-                        user_choice = max_columns_possible_under_limit
-                    elif user_choice.upper() in ['X', 'EXIT', 'STOP']:
-                        throw_error_clause = True
-                    else:
-                        user_choice = int(user_choice)
-                    break
-                except ValueError:
-                    print('You entered a non integer value, try again.')
-                    continue
-            if not throw_error_clause:
-                temp = temp[temp['Key_ID']<=user_choice]
-
-        #### Need to throw an error if possible results are too large. Skip the whole thing       
-        if not throw_error_clause:
-            #### Pivot data on Dedupe_ID to get one row with as many columns as needed
-            temp['Key_ID'] = temp['Key_ID'].astype(str)
-            expanded_data = temp.pivot_table(index='Dedupe_ID',columns='Key_ID',values=columns_to_expand,aggfunc='first', fill_value='').sort_index(level=1,axis=1).reset_index()
-            
-            #### Clean up column names, order them from 1-whatever, and rename the id
-            expanded_data.columns = expanded_data.columns.map('_'.join)
-            cols_to_order = list(expanded_data.columns)
-            cols_to_order.sort(key=lambda x: int(x.split('_')[-1]) if x.split('_')[-1] != '' else 0)
-            expanded_data = expanded_data[cols_to_order]
-            expanded_data = expanded_data.rename({'Dedupe_ID_':'Dedupe_ID'}, axis=1)
-            
-            #### We just add a check that it is grouped properly so it will merge correctly back with the data
-            assert len(expanded_data) == len(expanded_data['Dedupe_ID'].unique()), "Expanding the Columns did not return a number equal to the unique number of dedupe ids"
-            #### Merge back with the data and drop the original columns that were expanded
-            data = data.merge(expanded_data, how='left', on='Dedupe_ID').fillna('')
-            data = data.drop(columns_to_expand, axis=1)
+        stage_start = start_stage(stage_callback)
+        data = expand_columns(data, columns_to_expand, max_expanded_columns=max_expanded_columns, max_memory=expand_max_memory, expand_format=expand_format)
+        report_stage(stage_callback, 'dedupe_dataframe', 'expand', stage_start, rows_in, len(data))
     
+    #### One stable sort by group then sort_column, shared by the rank and the deduped output
+    #### (the expansion merge keeps the row order, so the group codes still line up with the rows)
+    if add_rank_column or output_deduped_df:
+        stage_start = start_stage(stage_callback)
+        group_order, group_starts = sort_groups(group_codes, group_counts, data[sort_column], ascending=sort_ascending)
+        report_stage(stage_callback, 'dedupe_dataframe', 'sort', stage_start, rows_in, len(data))
+
     #### Add the Rank column. This just labels with the dedupe_id group 1-number of entries in group
     if add_rank_column:
-        print('\rAdding rank column', end=" "*50)
+        stage_start = start_stage(stage_callback)
         rank_column_name = "Rank" if rank_column_name=='' else rank_column_name
-        data[rank_column_name] = data.groupby("Dedupe_ID")[sort_column].rank(method="first",ascending=sort_ascending).astype(int)
+        #### The rank is the position in the sorted order minus where the group starts
+        ranks = np.empty(len(data), dtype=np.int64)
+        ranks[group_order] = np.arange(len(data)) - np.repeat(group_starts, group_counts) + 1
         if reset_blank_dedupe_combinations:
-            data.loc[(data['Dedupe_ID']==-1), rank_column_name] = 1
+            ranks[data['Dedupe_ID'].to_numpy() == -1] = 1
+        data[rank_column_name] = ranks
+        report_stage(stage_callback, 'dedupe_dataframe', 'rank', stage_start, rows_in, len(data))
 
     #### If true just take the first row within the group. All aggs were applied previously to every row so taking any row within group should give back correct agg for id
     if output_deduped_df:
-        data = data.sort_values(sort_column, ascending=sort_ascending)
-        data = data.groupby('Dedupe_ID').first().reset_index()            
+        stage_start = start_stage(stage_callback)
+        data = first_in_groups(data, group_codes, group_ids, group_order, group_starts, group_counts)
+        report_stage(stage_callback, 'dedupe_dataframe', 'output', stage_start, rows_in, len(data))
 
     #### Rename the Dedupe_Count to something else if input provided
     if output_column_name != '':
@@ -165,61 +173,265 @@ def dedupe_dataframe(
 
     return data
 
-def compare_dataframes(data1, data2, columns_to_compare=[], columns_to_bring_over=None, new_column_names=None, simplify_columns=False):
+def expand_columns(data, columns_to_expand, max_expanded_columns=None, max_memory=None, expand_format='wide'):
+    """
+    The expansion step of `dedupe_dataframe`. Needs the Dedupe_ID column
+    - columns_to_expand: `list` of columns. Each group gets one set of columns per unique combination of their values
+    - max_expanded_columns: Most columns made per expanded column. Default keeps all of them
+    - max_memory: Rough budget in bytes for the expanded columns (8 bytes a cell)
+    - expand_format: 'wide' for Phone_1, Phone_2, ... (Phone_1, Email_1, Phone_2, ... when there are several) or 'list'
+        to replace each column with a `list` of its values in the group
+    Never asks for input. Without a limit, more than 100,000,000 cells is cut down to fit under it with a warning
+    Returns the data with the new columns (and without the expanded ones for 'wide'). Missing values in the data are set to ''
+    """
+    if expand_format not in ['wide', 'list']:
+        raise ValueError("expand_format needs to be 'wide' or 'list', not {}".format(expand_format))
+    #### Group by columns desired so if multiple rows have the same exact info in cols provided, only one will be expanded
+    temp = data[['Dedupe_ID'] + columns_to_expand].groupby(['Dedupe_ID'] + columns_to_expand).first().reset_index()
+    #### Added on 10-13-22 if there is only one column being expanded, then lets not have any blanks
+    if len(columns_to_expand) == 1:
+        temp = temp[(temp[columns_to_expand[0]]!='') & (temp[columns_to_expand[0]].notnull())]
+    #### temp is sorted by Dedupe_ID, so each group is one run of rows and the key is the place in the run
+    expanded_ids, id_rows = np.unique(temp['Dedupe_ID'].to_numpy(), return_inverse=True)
+    id_starts = np.searchsorted(id_rows, np.arange(len(expanded_ids)))
+    key_ids = np.arange(len(temp)) - id_starts[id_rows]
+    number_of_keys = int(key_ids.max()) + 1 if len(temp) > 0 else 0
+
+    #### If there are too many columns and rows it will not fit. Limit to 100,000,000 entries unless a limit is given
+    #### Every record gets the columns of its group, so the cells made are rows x keys x columns
+    limit_on_entries = 100000000
+    cells_per_key = max(len(data) * len(columns_to_expand), 1)
+    keys_to_keep = number_of_keys
+    if max_expanded_columns is not None:
+        keys_to_keep = min(keys_to_keep, max_expanded_columns)
+    if max_memory is not None:
+        keys_to_keep = min(keys_to_keep, max(1, int(max_memory // (8 * cells_per_key))))
+    if (max_expanded_columns is None) and (max_memory is None) and (number_of_keys * cells_per_key > limit_on_entries):
+        keys_to_keep = max(1, int(limit_on_entries / cells_per_key))
+        warnings.warn("Expanding {} would make {:,} cells, so only {} column(s) per expanded column are kept. Set max_expanded_columns or expand_max_memory to choose".format(columns_to_expand, number_of_keys * cells_per_key, keys_to_keep))
+    is_kept = key_ids < keys_to_keep
+
+    #### Where each row of the data is in expanded_ids (groups with nothing to expand are not there)
+    data = data.reset_index(drop=True)
+    data_ids = data['Dedupe_ID'].to_numpy()
+    data_rows = np.minimum(np.searchsorted(expanded_ids, data_ids), max(len(expanded_ids) - 1, 0))
+    has_expansion = (data_rows < len(expanded_ids)) & (expanded_ids[data_rows] == data_ids) if len(expanded_ids) > 0 else np.zeros(len(data), dtype=bool)
+
+    if expand_format == 'list':
+        for column in columns_to_expand:
+            values = temp[column].to_numpy()[is_kept]
+            group_lists = np.empty(len(expanded_ids), dtype=object)
+            group_lists[:] = [list(group_values) for group_values in np.split(values, np.flatnonzero(np.diff(id_rows[is_kept])) + 1)] if values.size > 0 else []
+            data_lists = np.empty(len(data), dtype=object)
+            data_lists[:] = [[] for _ in range(len(data))]
+            data_lists[has_expansion] = group_lists[data_rows[has_expansion]]
+            data[column] = data_lists
+        return data.fillna('')
+
+    #### Scatter each column's values into a groups x keys array, then take the row of each record's group
+    data_grids = {}
+    for column in columns_to_expand if keys_to_keep > 0 else []:
+        is_number = is_number_column(temp[column])
+        grid = np.full((len(expanded_ids), keys_to_keep), np.nan if is_number else '', dtype=float if is_number else object)
+        grid[id_rows[is_kept], key_ids[is_kept]] = temp[column].to_numpy()[is_kept]
+        data_grids[column] = grid
+
+    #### Columns go key 1 of every column (in name order), then key 2, ... the same as the old pivot_table
+    expanded_data = {}
+    for key in range(keys_to_keep):
+        for column in sorted(columns_to_expand):
+            key_values = data_grids[column][data_rows, key]
+            key_values[~has_expansion] = np.nan if is_number_column(temp[column]) else ''
+            if is_number_column(temp[column]):
+                #### Numbers stay numbers, but a column with any blank becomes text with '' in the blanks
+                is_missing = np.isnan(key_values)
+                key_values = key_values.astype(temp[column].dtype) if not is_missing.any() else np.where(is_missing, '', key_values.astype(object))
+            expanded_data['{}_{}'.format(column, key + 1)] = key_values
+    #### Only the data can have missing values, the expanded columns are already filled
+    data = data.drop(columns_to_expand, axis=1).fillna('')
+    return pd.concat([data, pd.DataFrame(expanded_data, index=data.index)], axis=1)
+
+def is_number_column(values):
+    """
+    True for int and float columns (not bool)
+    """
+    return pd.api.types.is_numeric_dtype(values) and not pd.api.types.is_bool_dtype(values)
+
+def stream_dedupe_file(
+    input_path,
+    output_path,
+    deduping_columns,
+    columns=None,
+    chunk_size=1000000,
+    output_column_name='',
+    keep_dedupe_id_col=True,
+    add_rank_column=True,
+    rank_column_name='',
+    reset_blank_dedupe_combinations=True,
+    stage_callback=None
+):
+    """
+    ### Function: stream_dedupe_file
+    Exact dedupe of a file too big to fit in memory. Same Dedupe_ID and Dedupe_Count as `dedupe_dataframe` with
+    output_deduped_df=False, but only one chunk is in memory at a time
+    - input_path: CSV or Parquet file to dedupe (read as text, see `read_chunks`)
+    - output_path: Parquet file to write (or CSV if it ends in .csv). Every row of the input with the new columns
+    - deduping_columns: Columns to dedupe on. Is a `list`
+    - columns: Optional `list` of columns to read and write. Default is every column
+    - chunk_size: Rows read at a time
+    - output_column_name, keep_dedupe_id_col, add_rank_column, rank_column_name, reset_blank_dedupe_combinations: Same as `dedupe_dataframe`
+    - stage_callback: Optional function called with a `dict` after each pass (see `report_stage`)
+    The file is read twice. The first pass numbers every dedupe key and counts it, the second pass writes the rows.
+    Keys are kept as 64 bit hashes (about 24 bytes per unique key). Values are written as read, and Rank is the order
+    of the rows in the file (there is no sort_column)
+    Returns a `dict` with the number of Rows and Unique_Keys
+    """
+    count_column_name = 'Dedupe_Count' if output_column_name == '' else output_column_name
+    rank_column_name = 'Rank' if rank_column_name == '' else rank_column_name
+    read_columns = None if columns is None else list(dict.fromkeys(list(columns) + list(deduping_columns)))
+
+    #### First pass: number every key in the order it first shows up (same as factorize) and count it
+    stage_start = start_stage(stage_callback)
+    table_hashes, table_ids = np.array([], dtype=np.uint64), np.array([], dtype=np.int64)
+    counts = np.array([], dtype=np.int64)
+    blank_ids = set()
+    number_of_rows = 0
+    for chunk in read_chunks(input_path, columns=read_columns, chunk_size=chunk_size):
+        keys = dedupe_key(chunk, deduping_columns)
+        ids, table_hashes, table_ids = number_key_hashes(hash_keys(keys), table_hashes, table_ids)
+        counts = np.concatenate([counts, np.zeros(table_ids.size - counts.size, dtype=np.int64)])
+        counts += np.bincount(ids, minlength=counts.size)
+        blank_ids.update(np.unique(ids[(keys == '').to_numpy()]).tolist())
+        number_of_rows += len(chunk)
+    report_stage(stage_callback, 'stream_dedupe_file', 'count', stage_start, number_of_rows, table_ids.size)
+
+    #### Second pass: look the keys up again and write each chunk with the new columns
+    stage_start = start_stage(stage_callback)
+    is_blank_id = np.zeros(counts.size, dtype=bool)
+    is_blank_id[list(blank_ids)] = True
+    rows_seen = np.zeros(counts.size, dtype=np.int64)
+    writer = None
+    try:
+        for chunk_number, chunk in enumerate(read_chunks(input_path, columns=read_columns, chunk_size=chunk_size)):
+            keys = dedupe_key(chunk, deduping_columns)
+            ids = number_key_hashes(hash_keys(keys), table_hashes, table_ids)[0]
+            if columns is not None:
+                chunk = chunk[list(columns)].copy()
+            chunk_counts = counts[ids]
+            chunk_ranks = pd.Series(ids).groupby(ids).cumcount().to_numpy() + rows_seen[ids] + 1
+            rows_seen += np.bincount(ids, minlength=rows_seen.size)
+            if reset_blank_dedupe_combinations:
+                is_blank = is_blank_id[ids]
+                ids = np.where(is_blank, -1, ids)
+                chunk_counts = np.where(is_blank, 1, chunk_counts)
+                chunk_ranks = np.where(is_blank, 1, chunk_ranks)
+            if keep_dedupe_id_col:
+                chunk['Dedupe_ID'] = ids
+            chunk[count_column_name] = chunk_counts
+            if add_rank_column:
+                chunk[rank_column_name] = chunk_ranks
+            writer = write_chunk(chunk, output_path, writer, first_chunk=(chunk_number == 0))
+    finally:
+        if writer is not None:
+            writer.close()
+    report_stage(stage_callback, 'stream_dedupe_file', 'write', stage_start, number_of_rows, number_of_rows)
+    return {'Rows': number_of_rows, 'Unique_Keys': int(table_ids.size)}
+
+def compare_dataframes(data1, data2, columns_to_compare=[], columns_to_bring_over=None, new_column_names=None, simplify_columns=False, normalize_all_columns=False):
     """
     - columns_to_compare: columns to use as key in match/join
         - If you have different column names in both: Make a `tuple`
         - [(`Column_From_data1`, `Column_From_data2`), ...]
     - rename_new_column: Needs to be the same len as data2_column_to_join
     - simplify_columns: Remove everything but letters and numbers from compared columns
+    - normalize_all_columns: Spaces are collapsed and text upper cased only in the compared columns and the columns brought
+        over. Set True to clean every column like older versions
     """
-    data1, data2 = data1.copy(), data2.copy()
-
-    #### Standardize the data a bit before using it
-    data1 = data1.applymap(lambda x: " ".join(x.split()).upper().strip() if isinstance(x, str) else x)
-    data2 = data2.applymap(lambda x: " ".join(x.split()).upper().strip() if isinstance(x, str) else x)
+    #### The reference side is the same index that `build_reference_index` saves, just not kept
+    reference_index = build_reference_index(data2, columns_to_compare, columns_to_bring_over=columns_to_bring_over, new_column_names=new_column_names, simplify_columns=simplify_columns)
+    return compare_to_reference_index(data1, reference_index, normalize_all_columns=normalize_all_columns)
 
-    #### Add in ids for the columns to compare
-    if any([isinstance(i, tuple) for i in columns_to_compare]):
-        #### If columns have tuple split the tuples (This way we can use different columns without haveing to change col names)
-        data1['Combined_ID'] = data1[[k for (k,v) in columns_to_compare]].apply(lambda row: '_'.join(row.values.astype(str)), axis=1)
-        data2['Combined_ID'] = data2[[v for (k,v) in columns_to_compare]].apply(lambda row: '_'.join(row.values.astype(str)), axis=1)
-    else:
-        data1['Combined_ID'] = data1[columns_to_compare].apply(lambda row: '_'.join(row.values.astype(str)), axis=1)
-        data2['Combined_ID'] = data2[columns_to_compare].apply(lambda row: '_'.join(row.values.astype(str)), axis=1)
+def build_reference_index(data2, columns_to_compare=[], columns_to_bring_over=None, new_column_names=None, simplify_columns=False):
+    """
+    The data2 side of `compare_dataframes`, built once so many files can be checked against the same reference
+    (ex an already paid file) without normalizing, hashing and grouping it every time
+    - columns_to_compare, columns_to_bring_over, new_column_names, simplify_columns: Same as `compare_dataframes`
+    Returns a `dict` with the sorted key hashes, how many data2 rows have each one and the first row of the columns
+    brought over for each one. Save it with `save_reference_index` and use it with `compare_to_reference_index`
+    """
+    key_columns1 = [i[0] if isinstance(i, tuple) else i for i in columns_to_compare]
+    key_columns2 = [i[1] if isinstance(i, tuple) else i for i in columns_to_compare]
+    bring_over_columns = [] if columns_to_bring_over is None else (columns_to_bring_over if type(columns_to_bring_over) == list else [columns_to_bring_over])
+    data2 = normalize_columns(data2[list(dict.fromkeys(key_columns2 + bring_over_columns))].copy(), key_columns2 + bring_over_columns)
 
+    #### Hash the joined key of every row, same as data1 will be
+    combined2 = combine_columns(data2, key_columns2, separator='_')
     if simplify_columns:
-        data1['Combined_ID'] = data1['Combined_ID'].apply(lambda r: simplify_text(r))
-        data2['Combined_ID'] = data2['Combined_ID'].apply(lambda r: simplify_text(r))
-
-    #### Compare the IDs from both. Returns counts of matching from other df (0 means no matches, 1+ is number of matches from other df)    
-    data1['Matches_From_Other_DF'] = data1['Combined_ID'].map(data2['Combined_ID'].value_counts()).fillna(0).astype(int)
-
-    #### Get columns from one df to another (basically creating our own index to merge on)
-    if columns_to_bring_over is not None:
-        #### Convert single str to list 
-        if type(columns_to_bring_over) != list:
-            columns_to_bring_over = [columns_to_bring_over]            
-        
-        #### We can choose to rename the columns that we are pulling over (ie refnum -> old_refnum)
-        if new_column_names is not None:
-            #### Convert single str to list 
-            if type(new_column_names) != list:
-                new_column_names = [new_column_names]
-            data2 = data2.rename({x:y for x,y in zip(columns_to_bring_over, new_column_names)}, axis=1)
-            col_list = ['Combined_ID'] + new_column_names
-        else:
-            col_list = ['Combined_ID'] + columns_to_bring_over
-
-        #### Groupby ID and get first record to pull over to data1
-        data1 = data1.merge(
-            data2[col_list].groupby('Combined_ID').first().reset_index(), 
-            how='left', 
-            on='Combined_ID'
-        ).fillna('')
-
-    #### We do not need the Combined_ID in output
-    return data1[[i for i in data1.columns if i != 'Combined_ID']]
+        combined2 = combined2.str.replace(r'[^A-Za-z0-9\- ]+', '', regex=True)
+    data2['Combined_ID'] = hash_keys(combined2)
+
+    #### We can choose to rename the columns that we are pulling over (ie refnum -> old_refnum)
+    if new_column_names is not None:
+        new_column_names = new_column_names if type(new_column_names) == list else [new_column_names]
+        new_names = {x: y for x, y in zip(bring_over_columns, new_column_names)}
+        bring_over_columns = [new_names.get(column, column) for column in bring_over_columns]
+        data2 = data2.rename(new_names, axis=1)
+
+    #### Groupby ID and get first record to pull over. groupby sorts the IDs, so a lookup is a binary search
+    grouped = data2[['Combined_ID'] + bring_over_columns].groupby('Combined_ID')
+    counts = grouped.size()
+    return {
+        'Key_Columns': key_columns1,
+        'Simplify_Columns': simplify_columns,
+        'Bring_Over': columns_to_bring_over is not None,
+        'Hashes': counts.index.to_numpy(dtype=np.uint64),
+        'Counts': counts.to_numpy(dtype=np.int64),
+        'Columns': grouped.first().reset_index(drop=True),
+    }
+
+def save_reference_index(reference_index, path):
+    """
+    Saves an index from `build_reference_index` to a pickle file
+    """
+    pd.to_pickle(reference_index, path)
+
+def load_reference_index(path):
+    """
+    Loads an index saved with `save_reference_index`. Only load files you made, pickle can run code when it is read
+    """
+    return pd.read_pickle(path)
+
+def compare_to_reference_index(data1, reference_index, columns_to_compare=None, normalize_all_columns=False):
+    """
+    `compare_dataframes` against a prebuilt index from `build_reference_index`. Same output, but data2 is not touched,
+    so each call only costs the rows in data1
+    - columns_to_compare: data1 columns to use as the key. Default is the data1 columns the index was built with
+    - normalize_all_columns: Same as `compare_dataframes`
+    """
+    key_columns1 = reference_index['Key_Columns'] if columns_to_compare is None else [i[0] if isinstance(i, tuple) else i for i in columns_to_compare]
+    data1 = normalize_columns(data1.copy(), list(data1.columns) if normalize_all_columns else key_columns1)
+
+    #### Hash data1 the same way as the index, then binary search the sorted hashes of the index
+    combined1 = combine_columns(data1, key_columns1, separator='_')
+    if reference_index['Simplify_Columns']:
+        combined1 = combined1.str.replace(r'[^A-Za-z0-9\- ]+', '', regex=True)
+    hashes1 = hash_keys(combined1)
+    positions = np.minimum(np.searchsorted(reference_index['Hashes'], hashes1), max(len(reference_index['Hashes']) - 1, 0))
+    is_match = (reference_index['Hashes'][positions] == hashes1) if len(reference_index['Hashes']) > 0 else np.zeros(len(data1), dtype=bool)
+
+    #### Compare the IDs from both. Returns counts of matching from other df (0 means no matches, 1+ is number of matches from other df)
+    data1['Matches_From_Other_DF'] = np.where(is_match, reference_index['Counts'][positions] if len(reference_index['Counts']) > 0 else 0, 0)
+    if not reference_index['Bring_Over']:
+        return data1
+
+    #### Get columns from the index to data1. Rows without a match get blanks, same as a left merge with fillna('')
+    brought_over = reference_index['Columns'].iloc[np.where(is_match, positions, 0)] if len(reference_index['Hashes']) > 0 else pd.DataFrame(np.nan, index=data1.index, columns=reference_index['Columns'].columns)
+    brought_over = brought_over.where(np.repeat(is_match[:, None], brought_over.shape[1], axis=1))
+    #### Lined up by position, not index, so repeated index labels in data1 do not multiply rows. Names in both get _x and _y like a merge
+    both = [column for column in brought_over.columns if column in data1.columns]
+    data1 = data1.rename({column: column + '_x' for column in both}, axis=1).reset_index(drop=True)
+    brought_over = brought_over.rename({column: column + '_y' for column in both}, axis=1).reset_index(drop=True)
+    return pd.concat([data1, brought_over], axis=1).fillna('')
 
 #########################################
 ### Helper Functions
@@ -230,21 +442,222 @@ def add_dedupe_id_column(data, deduping_columns, reset_blank_dedupe_combinations
     #### Returns a list of numbered groups corresponding to the dedupe col combinations that is assign to a new col in the df
     #### (11-18-22) Split this out to combine the dedupe columns, remove all spaces, and compare that way. This should make it so 123 Main Apt 3 == 123 Main | Apt 3
     #### If the combined string is empty set the id = -1 to filter out later. Blank is useless to us.
-    data['Combined_deduping_columns'] = data[deduping_columns].apply(lambda row: "".join(''.join(row.values.astype(str)).split()), axis=1)
-    data["Dedupe_ID"] = pd.factorize(data['Combined_deduping_columns'])[0]
+    #### The combined string is built one column at a time and hashed to 64 bits, so factorize works on numbers
+    combined = combine_columns(data, deduping_columns, remove_spaces=True)
+    data["Dedupe_ID"] = pd.factorize(hash_keys(combined))[0]
     if reset_blank_dedupe_combinations:
-        data.loc[(data['Combined_deduping_columns']==''), 'Dedupe_ID'] = -1
-    data = data.drop('Combined_deduping_columns',axis=1)
+        data["Dedupe_ID"] = np.where(combined.to_numpy() == '', -1, data["Dedupe_ID"].to_numpy())
+    return data
+
+def combine_columns(data, columns, separator='', remove_spaces=False):
+    """
+    Joins the columns of each row into one string, one column at a time. Same as `separator.join(row.values.astype(str))` per row
+    - remove_spaces: Take every space out of the joined string. Done on each column's unique values before joining
+    Returns a `Series` of strings
+    """
+    combined = None
+    for column in columns:
+        values = data[column].astype(str)
+        if remove_spaces:
+            codes, uniques = pd.factorize(values)
+            values = pd.Series(np.array(["".join(x.split()) for x in uniques], dtype=object)[codes], index=data.index)
+        combined = values if combined is None else combined + separator + values
+    return pd.Series('', index=data.index) if combined is None else combined
+
+def hash_keys(keys):
+    """
+    64 bit hash of every key string. Two different keys sharing a hash is vanishingly unlikely (about n^2 / 2^65 for n keys)
+    Returns a uint64 `array`
+    """
+    return pd.util.hash_array(keys.to_numpy(dtype=object))
+
+def normalize_text(values):
+    """
+    Vectorized `" ".join(x.split()).upper().strip()` for one column. Values that are not text (numbers, NaN) are left as they are
+    Each unique value is only cleaned once and then spread back to the rows with its factorize code
+    """
+    codes, uniques = pd.factorize(values)
+    unique_is_text = np.array([isinstance(x, str) for x in uniques], dtype=bool)
+    if not unique_is_text.any():
+        return values
+    normalized = np.array([" ".join(x.split()).upper() if is_text else '' for x, is_text in zip(uniques, unique_is_text)], dtype=object)
+    #### Rows that are NaN (code -1) or not text keep their original value
+    row_is_text = (codes != -1) & unique_is_text[codes]
+    return values.where(~row_is_text, normalized[codes])
+
+def normalize_columns(data, columns):
+    """
+    Applies `normalize_text` to each of the columns (columns not in data are skipped). Changes data in place and returns it
+    """
+    for column in dict.fromkeys(columns):
+        if column in data.columns:
+            data[column] = normalize_text(data[column])
     return data
 
+def dedupe_key(data, deduping_columns):
+    """
+    Same combined key as `add_dedupe_id_column` after the `dedupe_dataframe` cleaning: the columns joined, upper case, without any spaces
+    """
+    return combine_columns(data, deduping_columns, remove_spaces=True).str.upper()
+
+def number_key_hashes(key_hashes, table_hashes, table_ids):
+    """
+    Looks up the Dedupe_ID of every key hash in a table of hashes seen so far. New hashes get the next ids, in the order
+    they first show up
+    - table_hashes, table_ids: Hashes sorted ascending and their ids. Start with empty `arrays`
+    Returns the id of every hash, and the updated table_hashes and table_ids
+    """
+    chunk_codes, chunk_hashes = pd.factorize(key_hashes)
+    chunk_hashes = np.asarray(chunk_hashes, dtype=np.uint64)
+    positions = np.searchsorted(table_hashes, chunk_hashes)
+    found = positions < table_hashes.size
+    found[found] = table_hashes[positions[found]] == chunk_hashes[found]
+    chunk_ids = np.empty(chunk_hashes.size, dtype=np.int64)
+    chunk_ids[found] = table_ids[positions[found]]
+    chunk_ids[~found] = table_ids.size + np.arange((~found).sum())
+    if not found.all():
+        #### Insert the new hashes in sorted order so the table stays sorted
+        new_order = np.argsort(chunk_hashes[~found], kind='stable')
+        insert_at = positions[~found][new_order]
+        table_hashes = np.insert(table_hashes, insert_at, chunk_hashes[~found][new_order])
+        table_ids = np.insert(table_ids, insert_at, chunk_ids[~found][new_order])
+    return chunk_ids[chunk_codes], table_hashes, table_ids
+
+def read_chunks(path, columns=None, chunk_size=500000):
+    """
+    Reads a CSV, Parquet or Excel file as text in chunks of rows, the same as `pd.read_excel(path, dtype=str).fillna("")`
+    - columns: Optional `list` of columns to read. Default reads every column
+    - chunk_size: Rows per chunk. Excel files are always one chunk
+    Yields a `DataFrame` for each chunk
+    """
+    extension = os.path.splitext(path)[1].lower()
+    if extension == '.parquet':
+        import pyarrow.parquet as pq
+        for batch in pq.ParquetFile(path).iter_batches(batch_size=chunk_size, columns=columns):
+            yield batch.to_pandas().fillna('').astype(str)
+    elif extension in ['.xlsx', '.xls']:
+        yield pd.read_excel(path, dtype=str, usecols=columns).fillna('')
+    else:
+        for chunk in pd.read_csv(path, dtype=str, usecols=columns, keep_default_na=False, chunksize=chunk_size):
+            yield chunk.fillna('')
+
+def write_chunk(data, path, writer=None, first_chunk=True):
+    """
+    Adds a chunk of rows to a Parquet file (or CSV if the path ends in .csv)
+    - writer: The Parquet writer returned for the last chunk. None for the first chunk
+    Returns the Parquet writer to pass with the next chunk (None for CSV). Close it after the last chunk
+    """
+    if os.path.splitext(path)[1].lower() == '.csv':
+        data.to_csv(path, index=False, mode='w' if first_chunk else 'a', header=first_chunk)
+        return None
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    table = pa.Table.from_pandas(data, preserve_index=False)
+    if writer is None:
+        writer = pq.ParquetWriter(path, table.schema)
+    writer.write_table(table.cast(writer.schema))
+    return writer
+
 def add_dedupe_count_column(data, deduping_columns, reset_blank_dedupe_combinations):
     #### We add the Dedupe_ID col and then get the counts associated with each ID assigned back to a new col
     data = add_dedupe_id_column(data, deduping_columns, reset_blank_dedupe_combinations=reset_blank_dedupe_combinations)
-    data['Dedupe_Count'] = data.groupby(['Dedupe_ID'])['Dedupe_ID'].transform('count')
+    group_codes, group_ids = number_groups(data['Dedupe_ID'].to_numpy())
+    data['Dedupe_Count'] = np.bincount(group_codes, minlength=len(group_ids))[group_codes]
     if reset_blank_dedupe_combinations:
-            data.loc[(data['Dedupe_ID']==-1), 'Dedupe_Count'] = 1
+        data['Dedupe_Count'] = np.where(data['Dedupe_ID'].to_numpy() == -1, 1, data['Dedupe_Count'].to_numpy())
     return data
 
+def number_groups(dedupe_ids):
+    """
+    Numbers the Dedupe_IDs 0 to number of groups - 1, in ascending Dedupe_ID order (so -1 is group 0 when there is one)
+    Returns the group code of every row and the Dedupe_ID of every group
+    """
+    codes, uniques = pd.factorize(dedupe_ids)
+    id_order = np.argsort(uniques, kind='stable')
+    code_positions = np.empty(len(uniques), dtype=np.int64)
+    code_positions[id_order] = np.arange(len(uniques))
+    return code_positions[codes], np.asarray(uniques)[id_order]
+
+def sort_groups(group_codes, group_counts, sort_values, ascending=True):
+    """
+    One stable sort of the rows by group, then by sort_values inside each group. Ties keep the order of the data and
+    missing sort values go last
+    Returns the row positions in sorted order and the position in that order where each group starts
+    """
+    value_order = pd.Series(sort_values.to_numpy()).sort_values(ascending=ascending, kind='stable', na_position='last').index.to_numpy()
+    group_order = value_order[np.argsort(group_codes[value_order], kind='stable')]
+    group_starts = np.cumsum(group_counts) - group_counts
+    return group_order, group_starts
+
+def first_in_groups(data, group_codes, group_ids, group_order, group_starts, group_counts):
+    """
+    Same as `data.groupby('Dedupe_ID').first().reset_index()` on data already in group_order, from `sort_groups`:
+    one row per group in Dedupe_ID order, and each column takes the first value in the group that is not missing
+    """
+    first_rows = group_order[group_starts]
+    other_columns = [column for column in data.columns if column != 'Dedupe_ID']
+    result = data[other_columns].iloc[first_rows].reset_index(drop=True)
+    sorted_codes = group_codes[group_order]
+    for column in other_columns:
+        is_missing = data[column].isna().to_numpy()
+        if not is_missing.any():
+            continue
+        #### Move each group's first row down to its first value that is not missing (if it has one)
+        has_value = ~is_missing[group_order]
+        value_groups, first_values = np.unique(sorted_codes[has_value], return_index=True)
+        first_positions = group_starts.copy()
+        first_positions[value_groups] = np.flatnonzero(has_value)[first_values]
+        result[column] = data[column].iloc[group_order[first_positions]].reset_index(drop=True)
+    result.insert(0, 'Dedupe_ID', group_ids)
+    return result
+
+def start_stage(stage_callback):
+    """
+    Start time to pass to `report_stage`. Nothing is measured when there is no stage_callback
+    """
+    return time.perf_counter() if stage_callback is not None else None
+
+def report_stage(stage_callback, function_name, stage, start_time, rows_in, rows_out):
+    """
+    Calls stage_callback with one `dict` for a finished stage. Does nothing when stage_callback is None
+    - function_name: Function the stage is in (ex 'dedupe_dataframe')
+    - stage: Name of the stage (ex 'normalize', 'similarity')
+    - start_time: From `start_stage`
+    - rows_in, rows_out: Rows going in and coming out of the stage. Some stages count other things, like matched pairs
+    The `dict` has Function, Stage, Seconds, Rows_In, Rows_Out and Peak_Memory_MB (peak of the whole process so far)
+    """
+    if stage_callback is None:
+        return
+    stage_callback({
+        'Function': function_name,
+        'Stage': stage,
+        'Seconds': time.perf_counter() - start_time,
+        'Rows_In': int(rows_in),
+        'Rows_Out': int(rows_out),
+        'Peak_Memory_MB': peak_memory_mb(),
+    })
+
+def peak_memory_mb():
+    """
+    Peak resident memory of this process in MB. None where the `resource` module is not available (Windows)
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    #### ru_maxrss is in bytes on macOS and in KB everywhere else
+    return round(peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024, 1)
+
+def make_logging_callback(logger=None, level=logging.INFO):
+    """
+    Makes a stage_callback that writes each stage to a logger
+    - logger: Logger to use. Default is the `Deduping_Files` logger
+    - level: Logging level for the stage messages
+    """
+    logger = logging.getLogger('Deduping_Files') if logger is None else logger
+    def log_stage(event):
+        logger.log(level, '%(Function)s %(Stage)s: %(Seconds).3fs, %(Rows_In)s rows in, %(Rows_Out)s rows out, peak memory %(Peak_Memory_MB)s MB', event)
+    return log_stage
+
 def create_additional_aggregation_dict(New_Column_Name, Agg_Column_Name, Agg_Type, Change_Dtype=None):
     """
     This is used in `Dedupe_Dataframe`. This function must be passed in a list to that function
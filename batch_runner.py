@@ -0,0 +1,142 @@
+## Runs dedupe, compare and address jobs from a JSON config, without a notebook or Excel
+## Run from the command line, example: python batch_runner.py jobs.json --verbose
+## Example config (options are passed straight to the function the job runs):
+## {
+##     "jobs": [
+##         {"name": "claims", "type": "dedupe", "input": "claims.csv", "output": "claims_deduped.parquet",
+##          "deduping_columns": ["Name", "Address"], "options": {"percent_match": 0.9, "block_on": ["Zip"]}},
+##         {"name": "prior", "type": "compare", "input": "claims.parquet", "input2": "prior_claims.parquet",
+##          "output": "prior_matches.parquet", "deduping_columns": ["Name", "Address"], "options": {"cross_source_only": true}},
+##         {"name": "addresses", "type": "address", "input": "claims.csv", "output": "claims_addresses.parquet",
+##          "address_column": "Full_Address", "columns": ["Claim_ID", "Full_Address"]}
+##     ]
+## }
+import argparse
+import json
+import logging
+import os
+
+import pandas as pd
+
+import Deduping_Files as dedup
+
+job_types = ['dedupe', 'exact_dedupe', 'compare', 'address']
+
+def read_table(path, columns=None, chunk_size=500000):
+    """
+    Reads a CSV, Parquet or Excel file as text, the same as `pd.read_excel(path, dtype=str).fillna("")`
+    - columns: Optional `list` of columns to read. Default reads every column
+    - chunk_size: Rows read at a time from CSV and Parquet, so the file is never parsed in one piece
+    """
+    chunks = list(dedup.read_chunks(path, columns=columns, chunk_size=chunk_size))
+    if not chunks:
+        return pd.DataFrame(columns=columns)
+    data = pd.concat(chunks, ignore_index=True)
+    return data if columns is None else data[columns]
+
+def write_table(data, path):
+    """
+    Writes the results to Parquet (default) or CSV if the path ends in .csv
+    Mixed columns (like `Group`, which is a number or blank) are written as text so Parquet can store them
+    """
+    if os.path.splitext(path)[1].lower() == '.csv':
+        data.to_csv(path, index=False)
+        return
+    data = data.copy()
+    for column in data.columns[data.dtypes == object]:
+        data[column] = data[column].astype(str)
+    data.to_parquet(path, index=False)
+
+def job_columns(job):
+    """
+    Columns to read for a job. None (every column) unless the job has `columns`, in which case the columns the job
+    needs are added to them
+    """
+    if job.get('columns') is None:
+        return None, None
+    options = job.get('options', {})
+    needed = list(job.get('deduping_columns', [])) + list(options.get('block_on') or [])
+    if job['type'] == 'address':
+        address_column = job['address_column']
+        needed += address_column if isinstance(address_column, list) else [address_column]
+    columns = list(dict.fromkeys(list(job['columns']) + needed))
+    if job['type'] != 'compare':
+        return columns, None
+    needed2 = list(job.get('deduping_columns2', job.get('deduping_columns', []))) + list(options.get('block_on') or [])
+    return columns, list(dict.fromkeys(list(job.get('columns2', job['columns'])) + needed2))
+
+def run_job(job, stage_callback=None):
+    """
+    Runs one job from the config and writes its output
+    - job: `dict` with `type` (one of `job_types`), `input`, `output` and what the type needs:
+        - dedupe: `deduping_columns`. Runs `fuzzy_dedupe_main`
+        - exact_dedupe: `deduping_columns`. Runs `dedupe_dataframe`, or `stream_dedupe_file` if `streaming` is true
+            (for files too big for memory, the file is never loaded whole)
+        - compare: `input2`, `deduping_columns` and optional `deduping_columns2` (default is the same columns) and `output2`
+            (also writes the input2 records). Runs `fuzzy_compare_dataframes`
+        - address: `address_column`. Runs `make_new_address_columns`
+        - Optional for all: `columns` (and `columns2` for input2) to only read some columns, `chunk_size` and `options`
+    - stage_callback: Optional function called with a `dict` after each stage (see `Deduping_Files.report_stage`)
+    """
+    if job['type'] not in job_types:
+        raise ValueError("job type needs to be one of {}, not {}".format(job_types, job['type']))
+    options = dict(job.get('options', {}))
+    chunk_size = job.get('chunk_size', 500000)
+    columns, columns2 = job_columns(job)
+
+    if (job['type'] == 'exact_dedupe') and job.get('streaming', False):
+        return dedup.stream_dedupe_file(job['input'], job['output'], job['deduping_columns'], columns=columns, chunk_size=chunk_size, stage_callback=stage_callback, **options)
+
+    stage_start = dedup.start_stage(stage_callback)
+    data = read_table(job['input'], columns=columns, chunk_size=chunk_size)
+    dedup.report_stage(stage_callback, 'run_job', 'read', stage_start, len(data), len(data))
+
+    if job['type'] == 'dedupe':
+        import fuzzy_dedupe_official as fuzzy
+        results = fuzzy.fuzzy_dedupe_main(data, job['deduping_columns'], stage_callback=stage_callback, **options)
+    elif job['type'] == 'exact_dedupe':
+        results = dedup.dedupe_dataframe(data, job['deduping_columns'], stage_callback=stage_callback, **options)
+    elif job['type'] == 'compare':
+        import fuzzy_dedupe_official as fuzzy
+        stage_start = dedup.start_stage(stage_callback)
+        data2 = read_table(job['input2'], columns=columns2, chunk_size=chunk_size)
+        dedup.report_stage(stage_callback, 'run_job', 'read', stage_start, len(data2), len(data2))
+        #### fuzzy_compare_dataframes tells the records apart with a source column
+        if 'source' not in data.columns:
+            data['source'] = 'DF1'
+        if 'source' not in data2.columns:
+            data2['source'] = 'DF2'
+        results = fuzzy.fuzzy_compare_dataframes(data, data2, job['deduping_columns'], job.get('deduping_columns2', job['deduping_columns']), return_both_sources=('output2' in job), stage_callback=stage_callback, **options)
+        if 'output2' in job:
+            results, results2 = results
+            write_table(results2, job['output2'])
+    else:
+        import Address_Cleaning as address
+        results = address.make_new_address_columns(data, job['address_column'], **options)
+
+    stage_start = dedup.start_stage(stage_callback)
+    write_table(results, job['output'])
+    dedup.report_stage(stage_callback, 'run_job', 'write', stage_start, len(results), len(results))
+    return results
+
+def run_config(config_path, job_names=None, stage_callback=None):
+    """
+    Runs the jobs in a JSON config file in order
+    - job_names: Optional `list` of job names to run. Default runs every job
+    """
+    with open(config_path) as file:
+        config = json.load(file)
+    for job in config['jobs']:
+        if (job_names is not None) and (job.get('name') not in job_names):
+            continue
+        logging.getLogger('batch_runner').info('Running job %s (%s)', job.get('name', ''), job['type'])
+        run_job(job, stage_callback=stage_callback)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run dedupe, compare and address jobs from a JSON config')
+    parser.add_argument('config', help='Path to the JSON config')
+    parser.add_argument('--jobs', nargs='+', help='Names of the jobs to run. Default runs every job')
+    parser.add_argument('--verbose', action='store_true', help='Log the time, rows and memory of every stage')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING, format='%(asctime)s %(message)s')
+    run_config(args.config, job_names=args.jobs, stage_callback=dedup.make_logging_callback() if args.verbose else None)
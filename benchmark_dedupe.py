@@ -0,0 +1,262 @@
+## Benchmarks for the dedupe, compare and address pipelines on made up claimant data
+## Run from the command line, example: python benchmark_dedupe.py --sizes 10000 100000 --output results.json
+## Every run is seeded, so the same sizes and seed always make the same records
+import argparse
+import json
+import multiprocessing
+import platform
+import time
+
+import numpy as np
+import pandas as pd
+
+first_names = ['JOHN', 'MARY', 'ROBERT', 'PATRICIA', 'MICHAEL', 'JENNIFER', 'WILLIAM', 'LINDA', 'DAVID', 'ELIZABETH', 'JAMES', 'BARBARA', 'RICHARD', 'SUSAN', 'JOSEPH', 'JESSICA', 'THOMAS', 'SARAH', 'CHARLES', 'KAREN', 'CHRISTOPHER', 'NANCY', 'DANIEL', 'LISA', 'MATTHEW', 'BETTY', 'ANTHONY', 'MARGARET', 'MARK', 'SANDRA', 'OSCAR', 'MARIA', 'JOSE', 'LUIS', 'ANA', 'CARLOS', 'WEI', 'MIN', 'PRIYA', 'RAJ']
+last_names = ['SMITH', 'JOHNSON', 'WILLIAMS', 'BROWN', 'JONES', 'GARCIA', 'MILLER', 'DAVIS', 'RODRIGUEZ', 'MARTINEZ', 'HERNANDEZ', 'LOPEZ', 'GONZALEZ', 'WILSON', 'ANDERSON', 'THOMAS', 'TAYLOR', 'MOORE', 'JACKSON', 'MARTIN', 'LEE', 'PEREZ', 'THOMPSON', 'WHITE', 'HARRIS', 'SANCHEZ', 'CLARK', 'RAMIREZ', 'LEWIS', 'ROBINSON', 'WALKER', 'YOUNG', 'ALLEN', 'KING', 'WRIGHT', 'SCOTT', 'NGUYEN', 'CHEN', 'PATEL', 'KIM']
+street_names = ['MAIN', 'OAK', 'PINE', 'MAPLE', 'CEDAR', 'ELM', 'WASHINGTON', 'LAKE', 'HILL', 'PARK', 'SUNSET', 'RIVER', 'LINCOLN', 'JACKSON', 'CHURCH', 'MILL', 'SPRING', 'RIDGE', 'FOREST', 'MEADOW']
+## Full street type -> the USPS abbreviation, used both ways to inject abbreviations
+street_types = {'STREET': 'ST', 'AVENUE': 'AVE', 'ROAD': 'RD', 'DRIVE': 'DR', 'LANE': 'LN', 'COURT': 'CT', 'BOULEVARD': 'BLVD', 'PLACE': 'PL', 'CIRCLE': 'CIR', 'PARKWAY': 'PKWY'}
+cities = [('SPRINGFIELD', 'IL', '627'), ('PORTLAND', 'OR', '972'), ('AUSTIN', 'TX', '787'), ('COLUMBUS', 'OH', '432'), ('DENVER', 'CO', '802'), ('MIAMI', 'FL', '331'), ('SEATTLE', 'WA', '981'), ('BOSTON', 'MA', '021'), ('PHOENIX', 'AZ', '850'), ('ATLANTA', 'GA', '303')]
+email_domains = ['GMAIL.COM', 'YAHOO.COM', 'HOTMAIL.COM', 'OUTLOOK.COM', 'AOL.COM', 'ICLOUD.COM']
+pipelines = ['dedupe_dataframe', 'fuzzy_dedupe_main', 'fuzzy_compare_dataframes', 'fuzzy_compare_dataframes_cross', 'make_new_address_columns']
+
+def make_claimant_records(number_of_records, duplicate_rate=.3, seed=0):
+    """
+    Makes realistic looking claimant records with known duplicates
+    - number_of_records: Total number of records (originals plus duplicates)
+    - duplicate_rate: Share of the records that are a changed copy of another record
+    - seed: Seed for the random generator. The same seed always makes the same records
+    Duplicates get one or more of: a typo, two letters swapped, the street type abbreviated (or spelled out),
+    an email ending in .CON, and extra spaces or lower case
+    Returns a `DataFrame` with Name, Email, Address, City, State, Zip, Full_Address, and True_ID (same for a record and its duplicates)
+    """
+    random_generator = np.random.default_rng(seed)
+    number_of_people = max(int(number_of_records * (1 - duplicate_rate)), 1)
+
+    def random_series(values):
+        return pd.Series(random_generator.choice(values, number_of_people))
+    def random_numbers(low, high, size=number_of_people):
+        return pd.Series(random_generator.integers(low, high, size)).astype(str)
+
+    first, last = random_series(first_names), random_series(last_names)
+    city_index = random_generator.integers(0, len(cities), number_of_people)
+    people = pd.DataFrame({
+        'Name': first + ' ' + last,
+        'Email': first.str[0] + last + random_numbers(1, 1000) + '@' + random_series(email_domains),
+        'Address': random_numbers(1, 20000) + ' ' + random_series(street_names) + ' ' + random_series(list(street_types)),
+        'City': [cities[i][0] for i in city_index],
+        'State': [cities[i][1] for i in city_index],
+        'Zip': [cities[i][2] + z.zfill(2) for i, z in zip(city_index, random_numbers(0, 100))],
+        'True_ID': np.arange(number_of_people),
+    })
+    #### Some addresses get an apartment
+    has_apartment = random_generator.random(number_of_people) < .2
+    people.loc[has_apartment, 'Address'] = people.loc[has_apartment, 'Address'] + ' APT ' + random_numbers(1, 400, has_apartment.sum()).to_numpy()
+
+    duplicates = people.iloc[random_generator.integers(0, number_of_people, number_of_records - number_of_people)].copy()
+    for column in ['Name', 'Email', 'Address']:
+        duplicates[column] = [change_text(text, column, random_generator) for text in duplicates[column]]
+
+    records = pd.concat([people, duplicates], ignore_index=True)
+    records = records.iloc[random_generator.permutation(len(records))].reset_index(drop=True)
+    records['Full_Address'] = records['Address'] + ', ' + records['City'] + ', ' + records['State'] + ' ' + records['Zip']
+    return records
+
+def change_text(text, column, random_generator):
+    """
+    Randomly changes a value the way people change resubmissions. About a third of the values are left alone
+    """
+    change = random_generator.integers(0, 6)
+    if change == 0 and len(text) > 3:
+        ## Typo: replace one letter
+        i = random_generator.integers(0, len(text))
+        text = text[:i] + chr(65 + random_generator.integers(0, 26)) + text[i + 1:]
+    elif change == 1 and len(text) > 3:
+        ## Transposition: swap two letters next to each other
+        i = random_generator.integers(0, len(text) - 1)
+        text = text[:i] + text[i + 1] + text[i] + text[i + 2:]
+    elif change == 2:
+        if column == 'Address':
+            ## Abbreviate the street type, or spell it out if it is already short
+            for full, short in street_types.items():
+                if text.endswith(' ' + full) or (' ' + full + ' ') in text:
+                    text = text.replace(' ' + full, ' ' + short)
+                    break
+                if text.endswith(' ' + short) or (' ' + short + ' ') in text:
+                    text = text.replace(' ' + short, ' ' + full)
+                    break
+        elif column == 'Email':
+            text = text[:-4] + '.CON' if text.endswith('.COM') else text
+        else:
+            text = text.title()
+    elif change == 3:
+        text = '  ' + text.replace(' ', '  ') + ' '
+    return text
+
+def pair_precision_recall(true_ids, predicted_ids):
+    """
+    Pairwise precision and recall of predicted groups against the true groups
+    - A pair is two records in the same group. Records with a predicted id of -1 (blank) are in no pair
+    Returns (precision, recall). Precision is 1 if nothing was paired
+    """
+    counts = pd.DataFrame({'True_ID': np.asarray(true_ids), 'Predicted_ID': np.asarray(predicted_ids)})
+    counts = counts[counts['Predicted_ID'] != -1]
+    def number_of_pairs(sizes):
+        sizes = sizes.to_numpy().astype(np.int64)
+        return int((sizes * (sizes - 1) // 2).sum())
+    true_pairs = number_of_pairs(pd.Series(np.asarray(true_ids)).value_counts())
+    predicted_pairs = number_of_pairs(counts['Predicted_ID'].value_counts())
+    correct_pairs = number_of_pairs(counts.groupby(['True_ID', 'Predicted_ID']).size())
+    precision = correct_pairs / predicted_pairs if predicted_pairs > 0 else 1.0
+    recall = correct_pairs / true_pairs if true_pairs > 0 else 1.0
+    return precision, recall
+
+def compare_halves(records):
+    """
+    Splits the records for the compare pipelines: the second half is looked for in the first half
+    Returns (df1, df2), each with a `source` column (DF1 or DF2) like `fuzzy_compare_dataframes` expects
+    """
+    half = len(records) // 2
+    df1, df2 = records.iloc[half:].reset_index(drop=True), records.iloc[:half].reset_index(drop=True)
+    df1['source'], df2['source'] = 'DF1', 'DF2'
+    return df1, df2
+
+def run_pipeline(pipeline, records, percent_match=.9):
+    """
+    Runs one pipeline on the records. This is the part that is timed
+    - fuzzy_compare_dataframes: The default path (both dfs stacked and deduped together)
+    - fuzzy_compare_dataframes_cross: With cross_source_only
+    Returns what the pipeline returned, for `score_pipeline`
+    """
+    import Deduping_Files as dedup
+    import Email_Cleaning as email
+    import fuzzy_dedupe_official as fuzzy
+
+    if pipeline == 'dedupe_dataframe':
+        data = records.copy()
+        data['Email'] = data['Email'].apply(email.fix_con_to_com)
+        return dedup.dedupe_dataframe(data, deduping_columns=['Name', 'Email'], output_deduped_df=False, keep_dedupe_id_col=True, add_rank_column=True)
+    if pipeline == 'fuzzy_dedupe_main':
+        return fuzzy.fuzzy_dedupe_main(records.copy(), ['Name', 'Email', 'Address'], percent_match=percent_match)
+    if pipeline in ['fuzzy_compare_dataframes', 'fuzzy_compare_dataframes_cross']:
+        df1, df2 = compare_halves(records)
+        return fuzzy.fuzzy_compare_dataframes(df1, df2, ['Name', 'Email', 'Address'], ['Name', 'Email', 'Address'], fuzzy_percentage=percent_match, return_both_sources=True, cross_source_only=(pipeline == 'fuzzy_compare_dataframes_cross'))
+    if pipeline == 'make_new_address_columns':
+        import Address_Cleaning as address
+        return address.make_new_address_columns(records, 'Full_Address')
+    raise ValueError("pipeline needs to be one of {}, not {}".format(pipelines, pipeline))
+
+def score_pipeline(pipeline, records, output, percent_match=.9):
+    """
+    Scores the output of `run_pipeline` against the known duplicates. Not timed
+    For the compare pipelines, every matched df1 x df2 pair is right if both records have the same True_ID, and recall is
+    out of every df1 x df2 pair with the same True_ID
+    Returns (precision, recall), or (None, None) for pipelines without groups to score
+    """
+    import fuzzy_dedupe_official as fuzzy
+
+    if pipeline in ['dedupe_dataframe', 'fuzzy_dedupe_main']:
+        return pair_precision_recall(output['True_ID'], output['Dedupe_ID'])
+    if pipeline not in ['fuzzy_compare_dataframes', 'fuzzy_compare_dataframes_cross']:
+        return None, None
+    df1, df2 = compare_halves(records)
+    if pipeline == 'fuzzy_compare_dataframes':
+        #### A df1 record is paired with every df2 record in its Dedupe_ID
+        matched1, all_df2 = output
+        pairs = matched1[['Dedupe_ID', 'True_ID']].merge(all_df2.loc[all_df2['Dedupe_ID'] != -1, ['Dedupe_ID', 'True_ID']], on='Dedupe_ID', suffixes=('_1', '_2'))
+        true_ids1, true_ids2 = pairs['True_ID_1'].to_numpy(), pairs['True_ID_2'].to_numpy()
+    else:
+        #### cross_source_only only keeps the match counts, so the pairs are found again with the same match it runs
+        df1['target'] = fuzzy.prep_duping_columns(df1, ['Name', 'Email', 'Address'], target_name='target')
+        df2['target'] = fuzzy.prep_duping_columns(df2, ['Name', 'Email', 'Address'], target_name='target')
+        pairs = fuzzy.fuzzy_cross_match(df1, df2, percent_match)
+        true_ids1, true_ids2 = df1['True_ID'].to_numpy()[pairs['Row_1'].to_numpy()], df2['True_ID'].to_numpy()[pairs['Row_2'].to_numpy()]
+    correct = int((true_ids1 == true_ids2).sum())
+    true_counts = df1['True_ID'].value_counts().to_frame('Count_1').join(df2['True_ID'].value_counts().to_frame('Count_2'), how='inner')
+    true_pairs = int((true_counts['Count_1'].astype(np.int64) * true_counts['Count_2']).sum())
+    precision = correct / len(true_ids1) if len(true_ids1) > 0 else 1.0
+    recall = correct / true_pairs if true_pairs > 0 else 1.0
+    return precision, recall
+
+def benchmark_one(pipeline, number_of_records, seed, percent_match):
+    """
+    Makes the records and runs one pipeline on them. Meant to run in its own process, so the peak memory is just this run
+    (including the made up records). Peak_RSS_MB is None on Windows (see `Deduping_Files.peak_memory_mb`)
+    Only `run_pipeline` is timed. Peak memory is read before the scoring
+    """
+    import Deduping_Files as dedup
+    records = make_claimant_records(number_of_records, seed=seed)
+    start = time.perf_counter()
+    output = run_pipeline(pipeline, records, percent_match=percent_match)
+    wall_seconds = time.perf_counter() - start
+    peak_memory = dedup.peak_memory_mb()
+    precision, recall = score_pipeline(pipeline, records, output, percent_match=percent_match)
+    return {
+        'Pipeline': pipeline,
+        'Rows': number_of_records,
+        'Seed': seed,
+        'Percent_Match': percent_match,
+        'Wall_Seconds': round(wall_seconds, 4),
+        'Peak_RSS_MB': peak_memory,
+        'Precision': precision,
+        'Recall': recall,
+    }
+
+def run_benchmarks(sizes=(10000, 100000, 1000000), pipelines_to_run=None, seed=0, percent_match=.9, output_path=None):
+    """
+    Runs every pipeline at every size, each in a new process
+    - sizes: Number of records for each run
+    - pipelines_to_run: `list` of pipeline names. Default is all of `pipelines`
+    - output_path: Optional path to write the results to as JSON (with the python and package versions)
+    Returns a `DataFrame` with one row per run. A run that fails has an `Error` instead of timings
+    """
+    pipelines_to_run = pipelines if pipelines_to_run is None else pipelines_to_run
+    results = []
+    context = multiprocessing.get_context('spawn')
+    for number_of_records in sizes:
+        for pipeline in pipelines_to_run:
+            #### One failed pipeline should not stop the rest of the runs
+            try:
+                with context.Pool(1) as pool:
+                    result = pool.apply(benchmark_one, (pipeline, number_of_records, seed, percent_match))
+            except Exception as e:
+                result = {'Pipeline': pipeline, 'Rows': number_of_records, 'Seed': seed, 'Percent_Match': percent_match, 'Error': repr(e)}
+            print(json.dumps(result))
+            results.append(result)
+
+    if output_path is not None:
+        with open(output_path, 'w') as file:
+            json.dump({
+                'Python': platform.python_version(),
+                'Pandas': pd.__version__,
+                'Numpy': np.__version__,
+                'Machine': platform.platform(),
+                'Results': results,
+            }, file, indent=2)
+    return pd.DataFrame(results)
+
+def compare_benchmarks(old_path, new_path):
+    """
+    Lines up two result files from `run_benchmarks`. Speedup above 1 means the new run was faster
+    """
+    def load(path):
+        with open(path) as file:
+            return pd.DataFrame(json.load(file)['Results']).set_index(['Pipeline', 'Rows'])
+    old, new = load(old_path), load(new_path)
+    compared = old[['Wall_Seconds', 'Peak_RSS_MB', 'Precision', 'Recall']].join(new[['Wall_Seconds', 'Peak_RSS_MB', 'Precision', 'Recall']], lsuffix='_Old', rsuffix='_New', how='inner')
+    compared['Speedup'] = compared['Wall_Seconds_Old'] / compared['Wall_Seconds_New']
+    #### Peak memory is blank for runs on Windows
+    compared['Memory_Ratio'] = pd.to_numeric(compared['Peak_RSS_MB_New'], errors='coerce') / pd.to_numeric(compared['Peak_RSS_MB_Old'], errors='coerce')
+    return compared.reset_index()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the dedupe pipelines on made up claimant records')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000, 1000000])
+    parser.add_argument('--pipelines', nargs='+', choices=pipelines, default=pipelines)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--percent-match', type=float, default=.9)
+    parser.add_argument('--output', help='Path for the JSON results')
+    parser.add_argument('--compare', help='Older JSON results to compare the new results against (needs --output)')
+    args = parser.parse_args()
+    run_benchmarks(args.sizes, args.pipelines, seed=args.seed, percent_match=args.percent_match, output_path=args.output)
+    if args.compare and args.output:
+        print(compare_benchmarks(args.compare, args.output).to_string(index=False))
@@ -1,78 +1,743 @@
 import pandas as pd
 import numpy as np 
+import hashlib
+import json
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
 
 
 import Deduping_Files as dedup
-from sklearn.feature_extraction.text import TfidfVectorizer 
+from sklearn.feature_extraction.text import TfidfVectorizer, TfidfTransformer
+from scipy import sparse
+from scipy.sparse.csgraph import connected_components
 
 
 
 
-def prep_duping_columns(df,deduping_cols,target_name = 'target'):
-    print(deduping_cols)
+def prep_duping_columns(df,deduping_cols,target_name = 'target', stage_callback = None):
+    stage_start = dedup.start_stage(stage_callback)
     df['target'] =df[deduping_cols].apply(" ".join,axis =1 )
     df['target']= df['target'].str.upper()
     df['target']= df['target'].str.strip()
+    dedup.report_stage(stage_callback, 'prep_duping_columns', 'prep', stage_start, len(df), len(df))
     return df['target']
 
 import re 
 import pandas as pd 
 # from sklearn.feature_extraction.text import TfidfVectorizer 
 from sparse_dot_topn import awesome_cossim_topn
-def fuzzy_dedupe(df, percent_match = .9):
-    #group hash table 
-    group_lookup = {}
-
-    #cleaning strings and return ngrames
-    def ngrams_analyzer(string,number_of_grams=5):
-        string = re.sub(r'[,-./]',r'',string)
-        ngrams = zip(*[string[i:] for i in range(number_of_grams)])
-        return [''.join(ngram) for ngram in ngrams]
-
-    def find_group(row,col):
-        if row in group_lookup:
-            return group_lookup[row]
-        elif col in group_lookup:
-            return group_lookup[col]
-        else:
-            return None 
-    def add_vals_to_lookup(group,row,col):
-        group_lookup[row] = group 
-        group_lookup[col] = group 
-
-    def add_pair_to_lookup(row,col):
-        group = find_group(row,col) #check if in group already 
-        if group is not None:
-            add_vals_to_lookup(group, row, col)
-        else:
-            add_vals_to_lookup(row,row,col)
+ngrams_punctuation = re.compile(r'[,-./]')
+#### Mersenne prime for the MinHash hashes. Bigger than any number of ngram columns
+minhash_prime = 2**31 - 1
+
+#cleaning strings and return ngrames
+def ngrams_analyzer(string,number_of_grams=5):
+    string = ngrams_punctuation.sub(r'',string)
+    return [string[i:i + number_of_grams] for i in range(len(string) - number_of_grams + 1)]
 
-    #create vecotirzer for matrix
+def fit_tfidf(vals, number_of_grams=5):
+    """
+    Same result as `TfidfVectorizer(analyzer=ngrams_analyzer).fit_transform(vals)`, but the ngrams are made in bulk.
+    The punctuation is stripped over the whole array at once, the ngrams of a cleaned string are only made once even if
+    it shows up more than once, and the vocabulary is built with one `pd.factorize` instead of a dict lookup per ngram
+    Returns the fitted vectorizer (to transform new targets) and the tfidf matrix
+    """
+    cleaned_codes, cleaned = pd.factorize(pd.Series(vals, dtype=object).str.replace(ngrams_punctuation, '', regex=True))
+    ngram_counts = np.array([max(len(string) - number_of_grams + 1, 0) for string in cleaned], dtype=np.int64)
+    ngrams = [string[i:i + number_of_grams] for string in cleaned for i in range(len(string) - number_of_grams + 1)]
+    #### Sorted so the columns are in the same order as the sklearn vocabulary
+    ngram_codes, vocabulary = pd.factorize(np.array(ngrams, dtype=object), sort=True)
+    indptr = np.concatenate([[0], np.cumsum(ngram_counts)])
+    count_matrix = sparse.csr_matrix((np.ones(len(ngram_codes)), ngram_codes, indptr), shape=(len(cleaned), len(vocabulary)))
+    count_matrix.sum_duplicates()
+
+    transformer = TfidfTransformer()
+    tfidf_matrix = transformer.fit_transform(count_matrix[cleaned_codes])
     vectorizer = TfidfVectorizer(analyzer=ngrams_analyzer)
-    #Target column 
-    vals = df['target'].unique().astype('U')
+    vectorizer.vocabulary_ = {ngram: column for column, ngram in enumerate(vocabulary)}
+    vectorizer.idf_ = transformer.idf_
+    return vectorizer, tfidf_matrix
+
+def fuzzy_dedupe(df, percent_match = .9, block_on = None, ntop = None, n_jobs = 1, max_memory = None, tfidf_cache = None, method = 'exact', return_edges = False, edges_path = None, stage_callback = None, n_processes = 1):
+    """
+    Marks approximate matches in the `target` column with a shared `Group` number
+    - percent_match: Cosine similarity two targets need to be put in the same group
+    - block_on: Optional `list` of columns (ex ['Zip_Code', 'State']). Targets are only compared against targets
+        with the exact same values in these columns, so the similarity join runs per block instead of every
+        target against every other target. For something like the first letter of a last name, add it as a column first
+    - ntop: Most matches kept per target. Default keeps every match
+    - n_jobs: Number of threads used for the similarity multiplication
+    - max_memory: Rough budget in bytes. The similarity is done in slices of rows that fit in the budget, and the matched
+        pairs are folded into the groups whenever they grow past it. Default is to do everything in one go
+    - tfidf_cache: Optional saved master list from `load_tfidf_cache`. Targets in the master reuse their saved rows and
+        only new targets are vectorized, using the master's vocabulary and weights. Default fits on the targets in df
+    - method: 'exact' (default) compares every pair with sparse cosine. 'lsh' only scores candidate pairs found with
+        MinHash LSH on the same ngrams, which is close to linear but can miss some matches (see `lsh_recall`)
+    - return_edges: Also return the matched pairs as a `DataFrame` (`Row_1`, `Row_2`, `Score` as float32). Rows are positions
+        in df. Records with the exact same target (and block) are one node, so the pair uses the first row of each
+    - edges_path: Optional path to write the matched pairs to as Parquet (needs pyarrow)
+    - stage_callback: Optional function called with a `dict` after each stage (see `Deduping_Files.report_stage`).
+        Stages: vectorize (unique targets in, tfidf rows out), similarity (nodes in, matched pairs out), grouping
+    - n_processes: Number of processes for the similarity. The blocks from block_on are the shards, packed together or
+        split by rows so each process gets a similar amount of work (see `match_blocks`). Default runs in this process.
+        method='lsh' does not split blocks, so it only runs in more than one process with block_on
+    Groups are transitive: if A~B and B~C then A, B and C are all in one group. Blank targets keep a blank `Group`
+    Returns df, or (df, edges) if return_edges
+    """
+    #### Number every unique target. Everything after this works on the numbers instead of the strings
+    stage_start = dedup.start_stage(stage_callback)
+    target_codes, vals = pd.factorize(df['target'])
+    vals = np.asarray(vals).astype('U')
 
     #build matrix 
-    tfidf_matrix = vectorizer.fit_transform(vals)
+    tfidf_matrix = vectorize_targets(vals, tfidf_cache=tfidf_cache)
+    dedup.report_stage(stage_callback, 'fuzzy_dedupe', 'vectorize', stage_start, vals.size, tfidf_matrix.shape[0])
+
+    #### The matrix is fit once over every target so the weights are the same in every block
+    stage_start = dedup.start_stage(stage_callback)
+    node_codes, node_targets, blocks = make_nodes(df, target_codes, vals.size, block_on)
+    matched_pairs = 0
+
+    #### Matched pairs are held as node numbers until they pass the memory budget, then folded into the groups
+    node_groups = np.arange(len(node_targets))
+    pending_rows, pending_cols = [], []
+    pending_pairs = 0
+    keep_edges = return_edges or (edges_path is not None)
+    edges = []
+    for nodes1, nodes2, scores in match_blocks(tfidf_matrix, node_targets, blocks, percent_match, ntop=ntop, n_jobs=n_jobs, max_memory=max_memory, method=method, n_processes=n_processes):
+        pending_rows.append(nodes1)
+        pending_cols.append(nodes2)
+        pending_pairs += nodes1.size
+        matched_pairs += nodes1.size
+        if keep_edges:
+            one_way = nodes1 < nodes2
+            edges.append((nodes1[one_way], nodes2[one_way], scores[one_way]))
+        #### Two int64 node numbers per pair
+        if (max_memory is not None) and (pending_pairs * 16 > max_memory):
+            node_groups = connect_groups(node_groups, np.concatenate(pending_rows), np.concatenate(pending_cols))
+            pending_rows, pending_cols = [], []
+            pending_pairs = 0
+    dedup.report_stage(stage_callback, 'fuzzy_dedupe', 'similarity', stage_start, len(node_targets), matched_pairs)
+
+    stage_start = dedup.start_stage(stage_callback)
+    if pending_pairs > 0:
+        node_groups = connect_groups(node_groups, np.concatenate(pending_rows), np.concatenate(pending_cols))
+
+    #### Number the groups in the order they first show up in the data so the output is always the same
+    df['Group'] = pd.factorize(node_groups[node_codes])[0]
+    #### Keep blank targets blank so they are still reset by dedupe_dataframe
+    df['Group'] = df['Group'].where(df['target'] != '', '')
+    dedup.report_stage(stage_callback, 'fuzzy_dedupe', 'grouping', stage_start, len(df), len(df))
 
-    cosine_matrix = awesome_cossim_topn(tfidf_matrix, tfidf_matrix.transpose(), vals.size,percent_match) 
+    if keep_edges:
+        edges = make_edge_table(node_codes, edges)
+        if edges_path is not None:
+            edges.to_parquet(edges_path, index=False)
+        if return_edges:
+            return df, edges
+    return df
+
+def make_edge_table(node_codes, node_edges):
+    """
+    Turns matched node pairs into a compact table of row positions, using the first row of each node
+    - node_edges: `list` of (nodes, nodes, scores) `arrays`
+    Returns a `DataFrame` with `Row_1` and `Row_2` (int64) and `Score` (float32), sorted by the rows
+    """
+    first_rows = np.unique(node_codes, return_index=True)[1]
+    if node_edges:
+        nodes1, nodes2, scores = [np.concatenate(column) for column in zip(*node_edges)]
+    else:
+        nodes1, nodes2, scores = np.array([], dtype=np.int64), np.array([], dtype=np.int64), np.array([])
+    rows1, rows2 = first_rows[nodes1], first_rows[nodes2]
+    edges = pd.DataFrame({
+        'Row_1': np.minimum(rows1, rows2).astype(np.int64),
+        'Row_2': np.maximum(rows1, rows2).astype(np.int64),
+        'Score': scores.astype(np.float32),
+    })
+    return edges.sort_values(['Row_1', 'Row_2']).reset_index(drop=True)
+
+def make_nodes(df, target_codes, number_of_targets, block_on = None):
+    """
+    Each node is a unique target inside a block. Without blocking the nodes are just the unique targets
+    - target_codes: The `pd.factorize` codes of df['target']
+    Returns the node of every row, the target of every node, and a `list` with an `array` of nodes for each block
+    """
+    if block_on is None:
+        node_targets = np.arange(number_of_targets)
+        return target_codes, node_targets, [node_targets]
+    block_ids = df.groupby(block_on, sort=False, dropna=False).ngroup().to_numpy()
+    node_codes, node_keys = pd.factorize(block_ids.astype(np.int64) * number_of_targets + target_codes)
+    node_targets, node_blocks = node_keys % number_of_targets, node_keys // number_of_targets
+    block_order = np.argsort(node_blocks, kind='stable')
+    blocks = np.split(block_order, np.flatnonzero(np.diff(node_blocks[block_order])) + 1)
+    return node_codes, node_targets, blocks
+
+def match_blocks(tfidf_matrix, node_targets, blocks, percent_match, ntop = None, n_jobs = 1, max_memory = None, method = 'exact', n_processes = 1):
+    """
+    Self join of the nodes inside every block (from `make_nodes`)
+    - n_processes: Above 1 the blocks are packed into shards (see `make_shards`) that are matched in a `ProcessPoolExecutor`.
+        The matrix, the blocks and the node targets are saved to a temp folder and memory mapped by the workers, so they
+        are not pickled to each of them. With method='lsh' blocks are not split, so without block_on (one block) there is
+        only one shard and the extra processes do nothing
+    - Other arguments are the same as `match_rows`
+    Yields the node numbers of both sides and the scores of the matched pairs. A node is never paired with itself
+    """
+    if n_processes <= 1:
+        for block_nodes in blocks:
+            if block_nodes.size < 2:
+                continue
+            for block_rows, block_cols, scores in match_rows(tfidf_matrix[node_targets[block_nodes]], percent_match, ntop=ntop, n_jobs=n_jobs, max_memory=max_memory, method=method):
+                not_self = block_rows != block_cols
+                yield block_nodes[block_rows[not_self]], block_nodes[block_cols[not_self]], scores[not_self]
+        return
 
-    #build cordinate matrix 
-    coo_matrix = cosine_matrix.tocoo() 
+    shards = make_shards(blocks, n_processes * 4, split_blocks=(method == 'exact'))
+    if not shards:
+        return
+    with tempfile.TemporaryDirectory() as folder:
+        np.save(os.path.join(folder, 'matrix_data.npy'), tfidf_matrix.data)
+        np.save(os.path.join(folder, 'matrix_indices.npy'), tfidf_matrix.indices)
+        np.save(os.path.join(folder, 'matrix_indptr.npy'), tfidf_matrix.indptr)
+        np.save(os.path.join(folder, 'node_targets.npy'), node_targets)
+        np.save(os.path.join(folder, 'block_nodes.npy'), np.concatenate(blocks))
+        np.save(os.path.join(folder, 'block_starts.npy'), np.cumsum([0] + [block_nodes.size for block_nodes in blocks]))
+        #### Without blocking the one block is the whole matrix in order. It is transposed once here and memory mapped too,
+        #### so the workers do not copy or transpose the matrix at all
+        is_whole_matrix = (len(blocks) == 1) and (method == 'exact') and np.array_equal(node_targets[blocks[0]], np.arange(tfidf_matrix.shape[0]))
+        if is_whole_matrix:
+            matrix_transposed = tfidf_matrix.transpose().tocsr()
+            np.save(os.path.join(folder, 'transposed_data.npy'), matrix_transposed.data)
+            np.save(os.path.join(folder, 'transposed_indices.npy'), matrix_transposed.indices)
+            np.save(os.path.join(folder, 'transposed_indptr.npy'), matrix_transposed.indptr)
+            del matrix_transposed
+        with ProcessPoolExecutor(max_workers=n_processes) as executor:
+            yield from executor.map(match_shard, repeat(folder), repeat(tfidf_matrix.shape), shards, repeat(percent_match), repeat(ntop), repeat(n_jobs), repeat(max_memory), repeat(method), repeat(is_whole_matrix))
 
-    #creating pairs 
+def make_shards(blocks, number_of_shards, split_blocks = True):
+    """
+    Splits the blocks into about number_of_shards pieces of work with a similar number of rows. Small blocks are packed
+    together into one shard
+    - split_blocks: Split a block bigger than a shard by rows. Each piece of rows is still matched against the whole block
+    Returns a `list` of shards. Each shard is a `list` of (block number, first row, last row + 1). The pieces of a block
+    are next to each other, so a worker that gets several of them builds the block once (see `match_shard`)
+    """
+    total_rows = sum(block_nodes.size for block_nodes in blocks if block_nodes.size >= 2)
+    shard_size = max(1, -(-total_rows // number_of_shards))
+    shards, shard, rows_in_shard = [], [], 0
+    for block_number, block_nodes in enumerate(blocks):
+        if block_nodes.size < 2:
+            continue
+        piece_size = shard_size if split_blocks else block_nodes.size
+        for start in range(0, block_nodes.size, piece_size):
+            end = min(start + piece_size, block_nodes.size)
+            shard.append((block_number, start, end))
+            rows_in_shard += end - start
+            if rows_in_shard >= shard_size:
+                shards.append(shard)
+                shard, rows_in_shard = [], 0
+    if shard:
+        shards.append(shard)
+    return shards
+
+def load_csr(folder, name, shape):
+    """
+    Memory maps a csr matrix saved as name_data.npy, name_indices.npy and name_indptr.npy. Copy on write, so nothing is
+    read into memory until it is used
+    """
+    return sparse.csr_matrix((
+        np.load(os.path.join(folder, name + '_data.npy'), mmap_mode='c'),
+        np.load(os.path.join(folder, name + '_indices.npy'), mmap_mode='c'),
+        np.load(os.path.join(folder, name + '_indptr.npy'), mmap_mode='c'),
+    ), shape=shape, copy=False)
+
+#### The last block built by this worker process (see `match_shard`)
+worker_block = {'key': None, 'matrix': None, 'transposed': None}
+
+def match_shard(folder, matrix_shape, shard, percent_match, ntop = None, n_jobs = 1, max_memory = None, method = 'exact', is_whole_matrix = False):
+    """
+    Worker for `match_blocks`. Matches every piece in the shard using the memory mapped matrix in folder
+    Each block matrix (and its transpose) is built once and kept until the worker moves on to another block. When the
+    block is the whole matrix, the memory mapped matrix and transpose are used as they are
+    Returns the node numbers of both sides and the scores of the matched pairs (a node is never paired with itself)
+    """
+    block_nodes_all = np.load(os.path.join(folder, 'block_nodes.npy'), mmap_mode='r')
+    block_starts = np.load(os.path.join(folder, 'block_starts.npy'))
+    nodes1, nodes2, scores = [], [], []
+    for block_number, start, end in shard:
+        block_nodes = np.asarray(block_nodes_all[block_starts[block_number]:block_starts[block_number + 1]])
+        if worker_block['key'] != (folder, block_number):
+            #### Let go of the last block before building the next one
+            worker_block.update(key=None, matrix=None, transposed=None)
+            if is_whole_matrix:
+                block_matrix, transposed = load_csr(folder, 'matrix', matrix_shape), load_csr(folder, 'transposed', matrix_shape[::-1])
+            else:
+                node_targets = np.load(os.path.join(folder, 'node_targets.npy'), mmap_mode='r')
+                block_matrix = load_csr(folder, 'matrix', matrix_shape)[node_targets[block_nodes]]
+                transposed = block_matrix.transpose().tocsr() if method == 'exact' else None
+            worker_block.update(key=(folder, block_number), matrix=block_matrix, transposed=transposed)
+        block_matrix, transposed = worker_block['matrix'], worker_block['transposed']
+        if (start == 0) and (end == block_nodes.size):
+            piece_matches = match_rows(block_matrix, percent_match, ntop=ntop, n_jobs=n_jobs, max_memory=max_memory, method=method, other_transposed=transposed)
+        else:
+            piece_matches = match_rows(block_matrix[start:end], percent_match, ntop=ntop, n_jobs=n_jobs, max_memory=max_memory, other_matrix=block_matrix, method=method, other_transposed=transposed)
+        for block_rows, block_cols, piece_scores in piece_matches:
+            block_rows = block_rows + start
+            not_self = block_rows != block_cols
+            nodes1.append(block_nodes[block_rows[not_self]])
+            nodes2.append(block_nodes[block_cols[not_self]])
+            scores.append(piece_scores[not_self])
+    if not nodes1:
+        return np.array([], dtype=np.int64), np.array([], dtype=np.int64), np.array([], dtype=np.float32)
+    return np.concatenate(nodes1), np.concatenate(nodes2), np.concatenate(scores)
 
-    for row, col in zip(coo_matrix.row, coo_matrix.col):
-        if row != col: 
-            add_pair_to_lookup(vals[row],vals[col])
+def match_rows(tfidf_matrix, percent_match, ntop = None, n_jobs = 1, max_memory = None, other_matrix = None, method = 'exact', other_transposed = None):
+    """
+    Join of the rows in a tfidf matrix against the whole matrix (or other_matrix), done one slice of rows at a time
+    - ntop: Most matches kept per row. Default is the number of rows matched against (keep everything)
+    - n_jobs: Number of threads used by sparse_dot_topn
+    - max_memory: Rough budget in bytes for the result of one slice. Default is one slice for the whole matrix
+    - other_matrix: Optional tfidf matrix (same vocabulary) to match the rows against. Default is a self join
+    - method: 'exact' or 'lsh' (uses `lsh_match_rows`, ntop and n_jobs are not used)
+    - other_transposed: Optional other_matrix (or tfidf_matrix for a self join) already transposed to csr, so it is not transposed again
+    Yields the row numbers, column numbers and scores of every pair above percent_match for each slice
+    """
+    if method == 'lsh':
+        yield from lsh_match_rows(tfidf_matrix, percent_match, max_memory=max_memory, other_matrix=other_matrix)
+        return
+    if method != 'exact':
+        raise ValueError("method needs to be 'exact' or 'lsh', not {}".format(method))
+    other_matrix = tfidf_matrix if other_matrix is None else other_matrix
+    number_of_rows = tfidf_matrix.shape[0]
+    ntop = other_matrix.shape[0] if ntop is None else min(ntop, other_matrix.shape[0])
+    #### sparse_dot_topn sets aside ntop spots per row (4 byte column + 8 byte score)
+    slice_size = number_of_rows if max_memory is None else max(1, int(max_memory // (max(ntop, 1) * 12)))
+    #### Transpose once here instead of in every call
+    matrix_transposed = other_matrix.transpose().tocsr() if other_transposed is None else other_transposed
+    for start in range(0, number_of_rows, slice_size):
+        cosine_matrix = awesome_cossim_topn(tfidf_matrix[start:start + slice_size], matrix_transposed, ntop, percent_match, use_threads=n_jobs > 1, n_jobs=n_jobs) 
 
-    df['Group'] = df['target'].map(group_lookup).fillna(df['target'])
+        #build cordinate matrix 
+        coo_matrix = cosine_matrix.tocoo() 
+        yield coo_matrix.row + start, coo_matrix.col, coo_matrix.data
 
+def minhash_signatures(tfidf_matrix, number_of_hashes = 64, seed = 0):
+    """
+    MinHash signature of every row, using the ngram columns in the row as its set of shingles
+    Returns an `array` (rows x number_of_hashes). Rows without any ngrams are all `minhash_prime`
+    """
+    random_generator = np.random.default_rng(seed)
+    a = random_generator.integers(1, minhash_prime, number_of_hashes)
+    b = random_generator.integers(0, minhash_prime, number_of_hashes)
+    signatures = np.full((tfidf_matrix.shape[0], number_of_hashes), minhash_prime, dtype=np.int64)
+    has_ngrams = np.diff(tfidf_matrix.indptr) > 0
+    if not has_ngrams.any():
+        return signatures
+    columns = tfidf_matrix.indices.astype(np.int64)
+    row_starts = tfidf_matrix.indptr[:-1][has_ngrams]
+    for i in range(number_of_hashes):
+        #### Universal hash (a*x + b) mod p, then the lowest hash in each row
+        signatures[has_ngrams, i] = np.minimum.reduceat((a[i] * columns + b[i]) % minhash_prime, row_starts)
+    return signatures
+
+def lsh_candidate_pairs(signatures, band_size = 4, max_bucket_size = 100):
+    """
+    Rows that have the exact same signature values in at least one band of band_size hashes are candidates
+    - max_bucket_size: A row is only paired with up to this many other rows in the same bucket, so one huge
+        bucket can not blow up into every pair
+    Returns two `arrays` with the row numbers of each unique candidate pair (first row is always the lower number)
+    """
+    #### Rows without ngrams can not match anything and would all land in the same bucket
+    usable_rows = np.flatnonzero(signatures[:, 0] != minhash_prime)
+    pair_keys = []
+    for start in range(0, signatures.shape[1] - band_size + 1, band_size):
+        #### Mix the band into one 64 bit key. A collision only adds a candidate that gets checked anyway
+        band = signatures[usable_rows, start:start + band_size].astype(np.uint64)
+        bucket_keys = np.zeros(len(usable_rows), dtype=np.uint64)
+        for column in band.T:
+            bucket_keys = bucket_keys * np.uint64(1000003) + column
+        order = np.argsort(bucket_keys, kind='stable')
+        sorted_keys, sorted_rows = bucket_keys[order], usable_rows[order]
+        #### Buckets are runs of the same key, so pair each row with the next rows while they are in the same run
+        for offset in range(1, max_bucket_size + 1):
+            same_bucket = np.flatnonzero(sorted_keys[offset:] == sorted_keys[:-offset])
+            if same_bucket.size == 0:
+                break
+            first, second = sorted_rows[same_bucket], sorted_rows[same_bucket + offset]
+            pair_keys.append(np.minimum(first, second) * signatures.shape[0] + np.maximum(first, second))
+    if not pair_keys:
+        return np.array([], dtype=np.int64), np.array([], dtype=np.int64)
+    pair_keys = np.unique(np.concatenate(pair_keys))
+    return pair_keys // signatures.shape[0], pair_keys % signatures.shape[0]
+
+def lsh_match_rows(tfidf_matrix, percent_match, max_memory = None, other_matrix = None, number_of_hashes = 64, band_size = 4, max_bucket_size = 100, seed = 0):
+    """
+    Approximate version of `match_rows`. Candidate pairs come from MinHash LSH on the ngrams, and only the
+    candidates get their cosine similarity checked against percent_match
+    - number_of_hashes, band_size: More bands (number_of_hashes / band_size) finds more matches but makes more candidates
+    - max_bucket_size: See `lsh_candidate_pairs`
+    - max_memory: Rough budget in bytes for checking candidates. Default checks them all at once
+    Yields the row numbers, column numbers and scores of the pairs above percent_match (same as `match_rows`)
+    """
+    number_of_rows = tfidf_matrix.shape[0]
+    stacked_matrix = tfidf_matrix if other_matrix is None else sparse.vstack([tfidf_matrix, other_matrix]).tocsr()
+    rows, cols = lsh_candidate_pairs(minhash_signatures(stacked_matrix, number_of_hashes, seed), band_size, max_bucket_size)
+    if other_matrix is not None:
+        #### Only keep pairs with one row from each matrix, and make the column a row of other_matrix
+        is_cross = (rows < number_of_rows) & (cols >= number_of_rows)
+        rows, cols = rows[is_cross], cols[is_cross] - number_of_rows
+
+    #### Check the candidates in slices. Each candidate pair takes about the two rows it multiplies
+    other_matrix = tfidf_matrix if other_matrix is None else other_matrix
+    average_row_size = max(tfidf_matrix.nnz / max(number_of_rows, 1), 1) * 24
+    slice_size = max(len(rows), 1) if max_memory is None else max(1, int(max_memory // average_row_size))
+    for start in range(0, len(rows), slice_size):
+        slice_rows, slice_cols = rows[start:start + slice_size], cols[start:start + slice_size]
+        scores = np.asarray(tfidf_matrix[slice_rows].multiply(other_matrix[slice_cols]).sum(axis=1)).ravel()
+        is_match = scores > percent_match
+        yield slice_rows[is_match], slice_cols[is_match], scores[is_match]
+
+def lsh_recall(targets, percent_match = .9, sample_size = 10000, seed = 0, **lsh_options):
+    """
+    Checks how many of the exact matches the 'lsh' method finds, on a random sample of the unique targets
+    - targets: The `target` values to sample from (make them with `prep_duping_columns`)
+    - lsh_options: Passed to `lsh_match_rows` (number_of_hashes, band_size, max_bucket_size)
+    Returns a `dict` with the number of exact pairs, lsh pairs, exact pairs lsh found, and the recall
+    """
+    vals = pd.Series(pd.unique(pd.Series(targets)))
+    vals = vals.sample(min(sample_size, len(vals)), random_state=seed)
+    tfidf_matrix = fit_tfidf(np.asarray(vals).astype('U'))[1]
+
+    def pair_keys(matches):
+        keys = [np.minimum(rows, cols) * tfidf_matrix.shape[0] + np.maximum(rows, cols) for rows, cols, _ in matches]
+        keys = np.concatenate(keys) if keys else np.array([], dtype=np.int64)
+        #### Self matches are not pairs
+        return np.unique(keys[keys // tfidf_matrix.shape[0] != keys % tfidf_matrix.shape[0]])
+
+    exact_pairs = pair_keys(match_rows(tfidf_matrix, percent_match))
+    lsh_pairs = pair_keys(lsh_match_rows(tfidf_matrix, percent_match, **lsh_options))
+    found_pairs = np.intersect1d(exact_pairs, lsh_pairs).size
+    return {
+        'Exact_Pairs': exact_pairs.size,
+        'LSH_Pairs': lsh_pairs.size,
+        'Found_Pairs': found_pairs,
+        'Recall': found_pairs / exact_pairs.size if exact_pairs.size > 0 else 1.0,
+    }
+
+def connect_groups(node_groups, rows, cols):
+    """
+    Folds matched pairs into groups. Anything connected through a chain of matches ends up in the same group
+    - node_groups: `array` with the current group of every node. Start with `np.arange(number_of_nodes)`
+    - rows, cols: Node numbers of the matched pairs
+    Returns the updated `array` with the group number of every node
+    """
+    number_of_nodes = len(node_groups)
+    graph = sparse.coo_matrix((np.ones(len(rows), dtype=bool), (node_groups[rows], node_groups[cols])), shape=(number_of_nodes, number_of_nodes))
+    return connected_components(graph, directed=False)[1][node_groups]
+
+def vectorize_targets(vals, tfidf_cache = None):
+    """
+    Builds the tfidf matrix for an `array` of unique targets
+    - tfidf_cache: Optional saved master list from `load_tfidf_cache`. Default fits a new vectorizer on vals
+    """
+    if tfidf_cache is None:
+        return fit_tfidf(vals)[1]
+
+    #### Take the saved rows for targets already in the master and only vectorize the new ones
+    master_rows = tfidf_cache['target_index'].get_indexer(vals)
+    is_new = master_rows == -1
+    matrices = [tfidf_cache['matrix'][master_rows[~is_new]]]
+    if is_new.any():
+        matrices.append(tfidf_cache['vectorizer'].transform(vals[is_new]))
+    stacked_matrix = sparse.vstack(matrices).tocsr()
+    #### Put the rows back in the same order as vals
+    stacked_order = np.empty(vals.size, dtype=np.int64)
+    stacked_order[~is_new] = np.arange((~is_new).sum())
+    stacked_order[is_new] = np.arange((~is_new).sum(), vals.size)
+    return stacked_matrix[stacked_order]
+
+def load_tfidf_cache(master_targets, cache_dir):
+    """
+    Fits the tfidf on a master list and saves it to disk, or loads it if this master list was already saved
+    - master_targets: The `target` values of the master list (make them with `prep_duping_columns`)
+    - cache_dir: Folder for the caches. Each master list is saved in its own folder named by a hash of its targets
+    Returns a `dict` to pass as `tfidf_cache`. The saved matrix is memory mapped, not read into memory
+    """
+    vals = np.asarray(pd.unique(pd.Series(master_targets))).astype('U')
+    targets_hash = hashlib.sha256(pd.util.hash_array(vals.astype(object)).tobytes()).hexdigest()
+    folder = os.path.join(cache_dir, targets_hash)
+
+    if not os.path.exists(os.path.join(folder, 'metadata.json')):
+        vectorizer, tfidf_matrix = fit_tfidf(vals)
+        os.makedirs(folder, exist_ok=True)
+        np.save(os.path.join(folder, 'targets.npy'), vals)
+        np.save(os.path.join(folder, 'idf.npy'), vectorizer.idf_)
+        np.save(os.path.join(folder, 'matrix_data.npy'), tfidf_matrix.data)
+        np.save(os.path.join(folder, 'matrix_indices.npy'), tfidf_matrix.indices)
+        np.save(os.path.join(folder, 'matrix_indptr.npy'), tfidf_matrix.indptr)
+        with open(os.path.join(folder, 'vocabulary.json'), 'w') as file:
+            json.dump({k: int(v) for k, v in vectorizer.vocabulary_.items()}, file)
+        #### Metadata is written last so a half written folder is never loaded
+        with open(os.path.join(folder, 'metadata.json'), 'w') as file:
+            json.dump({'targets_hash': targets_hash, 'shape': list(tfidf_matrix.shape)}, file)
+
+    with open(os.path.join(folder, 'metadata.json')) as file:
+        metadata = json.load(file)
+    with open(os.path.join(folder, 'vocabulary.json')) as file:
+        vocabulary = json.load(file)
+    vectorizer = TfidfVectorizer(analyzer=ngrams_analyzer)
+    vectorizer.vocabulary_ = vocabulary
+    vectorizer.idf_ = np.load(os.path.join(folder, 'idf.npy'))
+    targets = np.load(os.path.join(folder, 'targets.npy'), mmap_mode='r')
+    tfidf_matrix = sparse.csr_matrix((
+        np.load(os.path.join(folder, 'matrix_data.npy'), mmap_mode='r'),
+        np.load(os.path.join(folder, 'matrix_indices.npy'), mmap_mode='r'),
+        np.load(os.path.join(folder, 'matrix_indptr.npy'), mmap_mode='r'),
+    ), shape=tuple(metadata['shape']), copy=False)
+    return {
+        'vectorizer': vectorizer,
+        'targets': targets,
+        'target_index': pd.Index(targets),
+        'matrix': tfidf_matrix,
+        'targets_hash': metadata['targets_hash'],
+    }
+
+def fuzzy_dedupe_main(df,deduping_cols1,percent_match = .9, block_on = None, ntop = None, n_jobs = 1, max_memory = None, tfidf_cache = None, method = 'exact', return_edges = False, edges_path = None, stage_callback = None, n_processes = 1):
+    df['target'] = prep_duping_columns(df,deduping_cols1,target_name = 'target', stage_callback=stage_callback)
+    df = fuzzy_dedupe(df, percent_match=percent_match, block_on=block_on, ntop=ntop, n_jobs=n_jobs, max_memory=max_memory, tfidf_cache=tfidf_cache, method=method, return_edges=return_edges, edges_path=edges_path, stage_callback=stage_callback, n_processes=n_processes)
+    if return_edges:
+        df, edges = df
+    df = dedup.dedupe_dataframe(
+    df, 
+    deduping_columns = ['Group'], 
+    output_deduped_df=False, 
+    keep_dedupe_id_col=True, 
+    add_rank_column=True,
+    reset_blank_dedupe_combinations=True,
+    stage_callback=stage_callback)
+    if return_edges:
+        return df, edges
     return df
 
-def fuzzy_dedupe_main(df,deduping_cols1,percent_match = .9):
+def fuzzy_dedupe_sweep(df, deduping_cols1, percent_matches, block_on = None, ntop = None, n_jobs = 1, max_memory = None, tfidf_cache = None, method = 'exact'):
+    """
+    Runs `fuzzy_dedupe_main` for several percent_match values while only doing the similarity once
+    - percent_matches: `list` of percent_match values to try (ex [.8, .85, .9, .95])
+    - Other arguments are the same as `fuzzy_dedupe_main`
+    The matched pairs are found once at the lowest value, then each value just keeps the pairs above it.
+    Scores are kept as float32, so a pair right at one of the higher values can land on either side of it
+    Returns a `dict` of percent_match -> deduped df (same as `fuzzy_dedupe_main`), and a `DataFrame` of group
+    stats for each percent_match to compare them
+    """
+    percent_matches = sorted(percent_matches)
     df['target'] = prep_duping_columns(df,deduping_cols1,target_name = 'target')
-    df = fuzzy_dedupe(df, percent_match=percent_match)
+    df, edges = fuzzy_dedupe(df, percent_match=percent_matches[0], block_on=block_on, ntop=ntop, n_jobs=n_jobs, max_memory=max_memory, tfidf_cache=tfidf_cache, method=method, return_edges=True)
+
+    #### Rows with the same target (and block) are one node, and the edges use the first row of each node
+    target_codes, vals = pd.factorize(df['target'])
+    node_codes = make_nodes(df, target_codes, len(vals), block_on)[0]
+    node_first_rows = np.unique(node_codes, return_index=True)[1][node_codes]
+
+    results, stats = {}, []
+    for percent_match in percent_matches:
+        #### Every edge is already above the lowest value
+        keep = (edges['Score'].to_numpy() > np.float32(percent_match)) | (percent_match == percent_matches[0])
+        row_groups = connect_groups(np.arange(len(df)), edges['Row_1'].to_numpy()[keep], edges['Row_2'].to_numpy()[keep])
+        data = df.copy()
+        data['Group'] = pd.factorize(row_groups[node_first_rows])[0]
+        data['Group'] = data['Group'].where(data['target'] != '', '')
+        data = dedup.dedupe_dataframe(
+        data, 
+        deduping_columns = ['Group'], 
+        output_deduped_df=False, 
+        keep_dedupe_id_col=True, 
+        add_rank_column=True,
+        reset_blank_dedupe_combinations=True)
+        results[percent_match] = data
+
+        #### Blank records (Dedupe_ID -1) are not a group
+        group_sizes = data.loc[data['Dedupe_ID'] != -1, 'Dedupe_ID'].value_counts()
+        stats.append({
+            'Percent_Match': percent_match,
+            'Pairs': int(keep.sum()),
+            'Groups': len(group_sizes),
+            'Duplicate_Groups': int((group_sizes > 1).sum()),
+            'Records_In_Duplicate_Groups': int(group_sizes[group_sizes > 1].sum()),
+            'Largest_Group': int(group_sizes.max()) if len(group_sizes) > 0 else 0,
+            'Average_Group_Size': float(group_sizes.mean()) if len(group_sizes) > 0 else 0.0,
+        })
+    return results, pd.DataFrame(stats)
+
+def fuzzy_dedupe_incremental(previous_df, new_df, deduping_cols1, percent_match = .9, block_on = None, ntop = None, n_jobs = 1, max_memory = None, tfidf_cache = None, method = 'exact'):
+    """
+    Adds a new batch of records to an already deduped dataset without redoing the whole history
+    - previous_df: Output of `fuzzy_dedupe_main` (or of this function). Needs `target`, `Group`, `Dedupe_ID`, `Dedupe_Count` and `Rank`
+    - new_df: The new records. Needs the deduping_cols1 columns (and the block_on columns if blocking)
+    - Other arguments are the same as `fuzzy_dedupe`. Use the same percent_match and block_on as the previous run
+    Only new targets are compared, against the previous and the new targets. Existing Dedupe_IDs are never renumbered:
+        - A new record with exactly the same target (and block) as an existing record takes its Dedupe_ID
+        - A new record that matches an existing group joins it and is ranked after the members already there
+        - A new record that matches more than one existing group joins the one with the lowest Dedupe_ID. Existing groups are not merged
+        - New records that only match each other get new Dedupe_IDs after the highest existing one
+    Only the previous records in the blocks of the new records are numbered into nodes and vectorized (all of them
+    without block_on, since every record is a candidate). Without tfidf_cache the tfidf is still fit on every target of
+    the history so the weights are the same as a full run, which grows with the history. To make a batch cost scale with
+    the new records, build a cache once from a fixed master list (ex the targets of the first full run) with
+    `load_tfidf_cache` and pass that same cache every batch. Targets not in the master are transformed with its
+    vocabulary instead of refitting. Do not build it from the growing previous_df, the cache folder is named by the
+    targets, so that would make and save a new one every batch
+    Returns previous_df with the new records added at the end (index reset) and Dedupe_Count updated
+    """
+    new_df = new_df.copy()
+    new_df['target'] = prep_duping_columns(new_df, deduping_cols1, target_name = 'target')
+    #### Same clean up dedupe_dataframe does to the previous run (its sort column, which is the first column)
+    new_df = dedup.normalize_columns(new_df, [previous_df.columns[0]])
+
+    #### Only previous records in a block with a new record can match, and records with the same target and block are
+    #### one node, so each previous node is only kept once
+    key_columns = ['target'] + ([] if block_on is None else block_on)
+    previous_nodes = previous_df[key_columns + ['Dedupe_ID']]
+    if block_on is not None:
+        #### Numbered the same way as make_nodes, so missing block values are a block too
+        block_ids = pd.concat([previous_nodes[block_on], new_df[block_on]], ignore_index=True).groupby(block_on, sort=False, dropna=False).ngroup().to_numpy()
+        previous_nodes = previous_nodes[np.isin(block_ids[:len(previous_nodes)], block_ids[len(previous_nodes):])]
+    previous_nodes = previous_nodes.drop_duplicates(key_columns)
+    number_previous = len(previous_nodes)
+
+    #### Number the targets and nodes over those previous nodes and the new records together
+    all_keys = pd.concat([previous_nodes[key_columns], new_df[key_columns]], ignore_index=True)
+    target_codes, vals = pd.factorize(all_keys['target'])
+    vals = np.asarray(vals).astype('U')
+    if tfidf_cache is None:
+        #### Fit on every target of the history so the weights are the same as a full run, then keep the rows needed
+        #### The needed targets go first, so their rows are the top of the fitted matrix
+        other_vals = np.asarray(pd.unique(previous_df['target'])).astype('U')
+        other_vals = other_vals[~pd.Index(other_vals).isin(vals)]
+        tfidf_matrix = fit_tfidf(np.concatenate([vals, other_vals]))[1][:vals.size]
+    else:
+        tfidf_matrix = vectorize_targets(vals, tfidf_cache=tfidf_cache)
+    node_codes, node_targets, blocks = make_nodes(all_keys, target_codes, vals.size, block_on)
+
+    #### Nodes already in the previous run keep their Dedupe_ID
+    node_dedupe_ids = np.full(len(node_targets), -2, dtype=np.int64)
+    node_dedupe_ids[node_codes[:number_previous]] = previous_nodes['Dedupe_ID'].to_numpy()
+    is_new_node = node_dedupe_ids == -2
+
+    #### Only the new nodes of each block are matched, against every node in the block
+    new_rows, new_cols, old_rows, old_ids = [], [], [], []
+    for block_nodes in blocks:
+        query_nodes = block_nodes[is_new_node[block_nodes]]
+        if query_nodes.size == 0:
+            continue
+        for block_rows, block_cols, _ in match_rows(tfidf_matrix[node_targets[query_nodes]], percent_match, ntop=ntop, n_jobs=n_jobs, max_memory=max_memory, other_matrix=tfidf_matrix[node_targets[block_nodes]], method=method):
+            rows, cols = query_nodes[block_rows], block_nodes[block_cols]
+            to_new = is_new_node[cols]
+            new_rows.append(rows[to_new])
+            new_cols.append(cols[to_new])
+            old_rows.append(rows[~to_new])
+            old_ids.append(node_dedupe_ids[cols[~to_new]])
+
+    #### New nodes are grouped with each other, then each group joins the lowest existing Dedupe_ID it touches
+    node_groups = np.arange(len(node_targets))
+    if new_rows:
+        node_groups = connect_groups(node_groups, np.concatenate(new_rows), np.concatenate(new_cols))
+    old_rows = np.concatenate(old_rows) if old_rows else np.array([], dtype=np.int64)
+    old_ids = np.concatenate(old_ids) if old_ids else np.array([], dtype=np.int64)
+    #### Blank targets never match anything, but never join the -1 group either
+    not_blank = old_ids != -1
+    attached_ids = pd.Series(old_ids[not_blank]).groupby(node_groups[old_rows[not_blank]]).min()
+
+    new_row_nodes = node_codes[number_previous:]
+    new_row_groups = node_groups[new_row_nodes]
+    new_ids = pd.Series(new_row_groups, index=new_df.index).map(attached_ids)
+    #### Records on a node from the previous run (exact resubmissions) are never matched, they take that node's Dedupe_ID
+    on_previous_node = ~is_new_node[new_row_nodes]
+    new_ids[on_previous_node] = node_dedupe_ids[new_row_nodes[on_previous_node]]
+    unattached = new_ids.isna()
+    first_new_id = previous_df['Dedupe_ID'].max() + 1
+    new_ids[unattached] = pd.factorize(new_row_groups[unattached.to_numpy()])[0] + first_new_id
+    new_ids = new_ids.astype(np.int64).where(new_df['target'] != '', -1)
+    new_df['Dedupe_ID'] = new_ids
+
+    #### New groups get new Group numbers, joined groups take the Group they joined
+    existing_groups = previous_df.drop_duplicates('Dedupe_ID').set_index('Dedupe_ID')['Group'].astype(object)
+    next_group = pd.to_numeric(previous_df['Group'], errors='coerce').max() + 1
+    next_group = 0 if pd.isna(next_group) else int(next_group)
+    is_new_group = unattached & (new_ids != -1)
+    new_df['Group'] = new_ids.map(existing_groups).mask(is_new_group, (new_ids - first_new_id + next_group).astype(object))
+    new_df['Group'] = new_df['Group'].where(new_ids != -1, '')
+
+    #### New members are ranked after the members already in the group, in the order they were added
+    previous_ranks = previous_df.groupby('Dedupe_ID')['Rank'].max()
+    new_df['Rank'] = new_ids.map(previous_ranks).fillna(0).astype(int) + new_df.groupby('Dedupe_ID').cumcount() + 1
+    new_df.loc[new_ids == -1, 'Rank'] = 1
+
+    data = pd.concat([previous_df, new_df], axis = 0, ignore_index = True)
+    data['Dedupe_Count'] = data.groupby('Dedupe_ID')['Dedupe_ID'].transform('count')
+    data.loc[data['Dedupe_ID'] == -1, 'Dedupe_Count'] = 1
+    return data
+
+
+
+
+
+def fuzzy_dedupe_fields(df, field_weights, field_scorers = None, percent_match = .9, candidate_percent_match = .5, block_on = None, ntop = None, n_jobs = 1, max_memory = None, method = 'exact'):
+    """
+    Fuzzy dedupe that scores each column on its own and combines the scores, instead of matching one combined target
+    - field_weights: `dict` of column -> weight (ex {'Name': 2, 'Email': 1, 'Address': 1})
+    - field_scorers: `dict` of column -> scorer. Columns not in the dict use 'tfidf'
+        - 'tfidf': Cosine similarity of the ngrams of the column (same as the normal fuzzy match)
+        - 'jaro_winkler': Jaro-Winkler similarity, good for short values like names. Run on n_jobs processes
+        - 'exact': 1 if the values are the same, else 0
+    - percent_match: Weighted average score two records need to be put in the same group. A column that is blank
+        in either record is left out of the average for that pair
+    - candidate_percent_match: Cosine similarity of the combined columns needed for a pair to be scored at all.
+        This is the one candidate pass for all columns, so keep it below percent_match
+    - Other arguments are the same as `fuzzy_dedupe` and are used for the candidate pass
+    Returns df with `target`, `Group`, `Dedupe_ID`, `Dedupe_Count` and `Rank` like `fuzzy_dedupe_main`
+    """
+    field_scorers = {} if field_scorers is None else field_scorers
+    fields = list(field_weights)
+    df['target'] = prep_duping_columns(df, fields, target_name = 'target')
+
+    #### A node is a unique combination of the (cleaned) field values, so every field has one value per node
+    field_values = pd.DataFrame({field: df[field].astype(str).str.upper().str.strip() for field in fields})
+    combination_codes = field_values.groupby(fields, sort=False, dropna=False).ngroup().to_numpy()
+    first_rows = np.unique(combination_codes, return_index=True)[1]
+    vals = df['target'].to_numpy()[first_rows].astype('U')
+    tfidf_matrix = vectorize_targets(vals)
+    node_codes, node_targets, blocks = make_nodes(df, combination_codes, vals.size, block_on)
+
+    #### Get every field ready to score node pairs
+    field_setups = {}
+    for field in fields:
+        field_codes, field_uniques = pd.factorize(field_values[field].to_numpy()[first_rows][node_targets])
+        field_uniques = np.asarray(field_uniques).astype('U')
+        scorer = field_scorers.get(field, 'tfidf')
+        if scorer not in ['tfidf', 'jaro_winkler', 'exact']:
+            raise ValueError("Scorer for {} needs to be 'tfidf', 'jaro_winkler' or 'exact', not {}".format(field, scorer))
+        field_matrix = fit_tfidf(field_uniques)[1] if scorer == 'tfidf' and (np.char.str_len(field_uniques) >= 5).any() else None
+        field_setups[field] = (scorer, field_codes, field_uniques, field_matrix)
+
+    #### One candidate pass on the combined columns, then score the candidates field by field
+    node_groups = np.arange(len(node_targets))
+    matched_rows, matched_cols = [], []
+    for block_nodes in blocks:
+        if block_nodes.size < 2:
+            continue
+        for block_rows, block_cols, _ in match_rows(tfidf_matrix[node_targets[block_nodes]], candidate_percent_match, ntop=ntop, n_jobs=n_jobs, max_memory=max_memory, method=method):
+            #### Pairs come both ways from the self join, only score them once
+            one_way = block_rows < block_cols
+            rows, cols = block_nodes[block_rows[one_way]], block_nodes[block_cols[one_way]]
+            scores = score_field_pairs(field_setups, field_weights, rows, cols, n_jobs=n_jobs)
+            matched_rows.append(rows[scores > percent_match])
+            matched_cols.append(cols[scores > percent_match])
+    if matched_rows:
+        node_groups = connect_groups(node_groups, np.concatenate(matched_rows), np.concatenate(matched_cols))
+
+    df['Group'] = pd.factorize(node_groups[node_codes])[0]
+    df['Group'] = df['Group'].where(df['target'] != '', '')
     df = dedup.dedupe_dataframe(
     df, 
     deduping_columns = ['Group'], 
@@ -82,24 +747,161 @@ def fuzzy_dedupe_main(df,deduping_cols1,percent_match = .9):
     reset_blank_dedupe_combinations=True)
     return df
 
+def score_field_pairs(field_setups, field_weights, rows, cols, n_jobs = 1):
+    """
+    Weighted average of the field scores for pairs of nodes. Fields blank in either node are left out of the pair's average
+    - field_setups: Built in `fuzzy_dedupe_fields`. Field -> (scorer, field code of each node, unique values, tfidf matrix)
+    Returns an `array` with the score of each pair (0 if every field is blank)
+    """
+    total_scores = np.zeros(len(rows))
+    total_weights = np.zeros(len(rows))
+    for field, (scorer, field_codes, field_uniques, field_matrix) in field_setups.items():
+        codes1, codes2 = field_codes[rows], field_codes[cols]
+        is_present = (field_uniques[codes1] != '') & (field_uniques[codes2] != '')
+        if scorer == 'exact':
+            scores = (codes1 == codes2).astype(float)
+        elif scorer == 'jaro_winkler':
+            scores = score_jaro_winkler(field_uniques, codes1, codes2, n_jobs=n_jobs)
+        elif field_matrix is None:
+            #### No value is long enough to make an ngram
+            scores = (codes1 == codes2).astype(float)
+        else:
+            scores = np.asarray(field_matrix[codes1].multiply(field_matrix[codes2]).sum(axis=1)).ravel()
+        total_scores += np.where(is_present, scores * field_weights[field], 0)
+        total_weights += np.where(is_present, field_weights[field], 0)
+    return np.divide(total_scores, total_weights, out=np.zeros(len(rows)), where=total_weights > 0)
+
+def score_jaro_winkler(field_uniques, codes1, codes2, n_jobs = 1, chunk_size = 50000):
+    """
+    Jaro-Winkler score for pairs of values (given as codes into field_uniques). Each unique pair is only scored once,
+    in chunks spread over n_jobs processes
+    """
+    pair_codes, unique_pairs = pd.factorize(pd.Series(codes1.astype(np.int64) * len(field_uniques) + codes2))
+    unique_pairs = np.asarray(unique_pairs)
+    value_pairs = list(zip(field_uniques[unique_pairs // len(field_uniques)], field_uniques[unique_pairs % len(field_uniques)]))
+    chunks = [value_pairs[i:i + chunk_size] for i in range(0, len(value_pairs), chunk_size)]
+    if n_jobs > 1 and len(chunks) > 1:
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            chunk_scores = list(executor.map(jaro_winkler_pairs, chunks))
+    else:
+        chunk_scores = [jaro_winkler_pairs(chunk) for chunk in chunks]
+    unique_scores = np.concatenate(chunk_scores) if chunk_scores else np.array([])
+    return unique_scores[pair_codes]
+
+def jaro_winkler_pairs(value_pairs):
+    return np.array([jaro_winkler(value1, value2) for value1, value2 in value_pairs])
 
+def jaro_winkler(text1, text2, prefix_weight = .1):
+    """
+    Jaro-Winkler similarity between two strings (1 is the same, 0 is nothing in common)
+    """
+    if text1 == text2:
+        return 1.0
+    length1, length2 = len(text1), len(text2)
+    if length1 == 0 or length2 == 0:
+        return 0.0
+    #### Characters only count as matching if they are close enough to each other
+    match_distance = max(max(length1, length2) // 2 - 1, 0)
+    matched1, matched2 = [False] * length1, [False] * length2
+    matches = 0
+    for i, character in enumerate(text1):
+        for j in range(max(0, i - match_distance), min(i + match_distance + 1, length2)):
+            if not matched2[j] and text2[j] == character:
+                matched1[i] = matched2[j] = True
+                matches += 1
+                break
+    if matches == 0:
+        return 0.0
+    #### Half the matched characters that are out of order
+    matched_characters2 = [text2[j] for j in range(length2) if matched2[j]]
+    transpositions = sum(character != matched_characters2[k] for k, character in enumerate(c for i, c in enumerate(text1) if matched1[i])) / 2
+    jaro = (matches / length1 + matches / length2 + (matches - transpositions) / matches) / 3
+    #### Boost for a shared start (up to 4 characters)
+    prefix = 0
+    for character1, character2 in zip(text1[:4], text2[:4]):
+        if character1 != character2:
+            break
+        prefix += 1
+    return jaro + prefix * prefix_weight * (1 - jaro)
 
+def fuzzy_cross_match(df1, df2, percent_match = .95, block_on = None, ntop = None, n_jobs = 1, max_memory = None, tfidf_cache = None, method = 'exact', stage_callback = None):
+    """
+    Matches the `target` column of df1 only against the `target` column of df2. Nothing is compared within the same df
+    - Other arguments are the same as `fuzzy_dedupe`. When blocking, both dfs need the block_on columns
+    Returns a `DataFrame` with one row per matched pair: `Row_1` (row position in df1), `Row_2` (row position in df2) and `Score`
+    """
+    number_df1 = len(df1)
+    key_columns = ['target'] + ([] if block_on is None else block_on)
+    all_keys = pd.concat([df1[key_columns], df2[key_columns]], ignore_index=True)
+    stage_start = dedup.start_stage(stage_callback)
+    target_codes, vals = pd.factorize(all_keys['target'])
+    vals = np.asarray(vals).astype('U')
+    tfidf_matrix = vectorize_targets(vals, tfidf_cache=tfidf_cache)
+    dedup.report_stage(stage_callback, 'fuzzy_cross_match', 'vectorize', stage_start, vals.size, tfidf_matrix.shape[0])
+    stage_start = dedup.start_stage(stage_callback)
+    node_codes, node_targets, blocks = make_nodes(all_keys, target_codes, vals.size, block_on)
 
+    #### A node can be in both dfs (same target in both)
+    in_df1 = np.zeros(len(node_targets), dtype=bool)
+    in_df2 = np.zeros(len(node_targets), dtype=bool)
+    in_df1[node_codes[:number_df1]] = True
+    in_df2[node_codes[number_df1:]] = True
 
-def fuzzy_compare_dataframes(df1,df2,deduping_cols1,deduping_cols2, fuzzy_percentage=.95, return_both_sources = False):
+    #### Only the df1 nodes of each block times the df2 nodes of the same block
+    node_pairs = []
+    for block_nodes in blocks:
+        nodes1, nodes2 = block_nodes[in_df1[block_nodes]], block_nodes[in_df2[block_nodes]]
+        if (nodes1.size == 0) or (nodes2.size == 0):
+            continue
+        for block_rows, block_cols, scores in match_rows(tfidf_matrix[node_targets[nodes1]], percent_match, ntop=ntop, n_jobs=n_jobs, max_memory=max_memory, other_matrix=tfidf_matrix[node_targets[nodes2]], method=method):
+            node_pairs.append(pd.DataFrame({'Node_1': nodes1[block_rows], 'Node_2': nodes2[block_cols], 'Score': scores.astype(np.float32)}))
+    node_pairs = pd.concat(node_pairs, ignore_index=True) if node_pairs else pd.DataFrame({'Node_1': [], 'Node_2': [], 'Score': []}).astype({'Node_1': np.int64, 'Node_2': np.int64, 'Score': np.float32})
+    dedup.report_stage(stage_callback, 'fuzzy_cross_match', 'similarity', stage_start, len(node_targets), len(node_pairs))
+
+    #### Every row with a matched node gets the pair
+    rows1 = pd.DataFrame({'Node_1': node_codes[:number_df1], 'Row_1': np.arange(number_df1)})
+    rows2 = pd.DataFrame({'Node_2': node_codes[number_df1:], 'Row_2': np.arange(len(df2))})
+    pairs = node_pairs.merge(rows1, on='Node_1').merge(rows2, on='Node_2')
+    return pairs[['Row_1', 'Row_2', 'Score']].sort_values(['Row_1', 'Row_2']).reset_index(drop=True)
+
+def fuzzy_compare_dataframes(df1,df2,deduping_cols1,deduping_cols2, fuzzy_percentage=.95, return_both_sources = False, block_on = None, ntop = None, n_jobs = 1, max_memory = None, tfidf_cache = None, cross_source_only = False, method = 'exact', stage_callback = None, n_processes = 1):
+    """
+    Finds the records in df1 that approximately match a record in df2
+    - deduping_cols1, deduping_cols2: Columns from each df that are combined and compared
+    - fuzzy_percentage: Cosine similarity needed for a match
+    - return_both_sources: Also return the df2 records
+    - cross_source_only: Only multiply df1 against df2 (no df1-df1 or df2-df2 work and no `source` column needed).
+        Adds `Matches_From_Other_DF` (number of matched records in the other df) and `Match_Score` (best score)
+        instead of the Group, Dedupe_ID and Rank columns
+    - stage_callback: Optional function called with a `dict` after each stage (see `Deduping_Files.report_stage`)
+    - n_processes: Processes used for the similarity when not cross_source_only (see `fuzzy_dedupe`)
+    - Other arguments are the same as `fuzzy_dedupe`
+    """
     df1 = df1.copy()
     df2 = df2.copy() 
-    df1['target'] = prep_duping_columns(df1,deduping_cols1,target_name = 'target')
-    df2['target'] = prep_duping_columns(df2,deduping_cols2,target_name = 'target')
+    df1['target'] = prep_duping_columns(df1,deduping_cols1,target_name = 'target', stage_callback=stage_callback)
+    df2['target'] = prep_duping_columns(df2,deduping_cols2,target_name = 'target', stage_callback=stage_callback)
+    if cross_source_only:
+        pairs = fuzzy_cross_match(df1, df2, fuzzy_percentage, block_on=block_on, ntop=ntop, n_jobs=n_jobs, max_memory=max_memory, tfidf_cache=tfidf_cache, method=method, stage_callback=stage_callback)
+        for data, row_column in [(df1, 'Row_1'), (df2, 'Row_2')]:
+            row_matches = pairs.groupby(row_column)['Score']
+            data['Matches_From_Other_DF'] = row_matches.size().reindex(np.arange(len(data)), fill_value=0).to_numpy()
+            data['Match_Score'] = row_matches.max().reindex(np.arange(len(data)), fill_value=0).to_numpy()
+        fuzzy_matches1_all_df1 = df1[df1['Matches_From_Other_DF'] > 0]
+        if return_both_sources:
+            return fuzzy_matches1_all_df1, df2
+        else:
+            return fuzzy_matches1_all_df1
     match1 = pd.concat([df1,df2],axis = 0 ).fillna("")
-    match1 = fuzzy_dedupe(match1.copy(),fuzzy_percentage)
+    match1 = fuzzy_dedupe(match1.copy(),fuzzy_percentage, block_on=block_on, ntop=ntop, n_jobs=n_jobs, max_memory=max_memory, tfidf_cache=tfidf_cache, method=method, stage_callback=stage_callback, n_processes=n_processes)
     match1 = dedup.dedupe_dataframe(
     match1, 
     deduping_columns = ['Group'], 
     output_deduped_df=False, 
     keep_dedupe_id_col=True, 
     add_rank_column=True,
-    reset_blank_dedupe_combinations=True)
+    reset_blank_dedupe_combinations=True,
+    stage_callback=stage_callback)
     #RUNNING HERE
     match1_df1 = match1[(match1['source'] =='DF2')]['Dedupe_ID'].tolist()
     match1['match'] = 0